@@ -2,8 +2,14 @@
 # Quick Self-Interpreting Language (QSIL)
 # By Hazel P., 2020. Licensed under the MIT License
 
-import ctypes
+import array
+import io
+import mmap
+import operator
+import os
 import struct
+import time
+import zlib
 
 imageFormat = 1 # The image format version we're using
 
@@ -14,6 +20,30 @@ QSIL_TYPE_DIRECTPOINTEROBJECT = 3 # Regular object with indexed variables, all o
 QSIL_TYPE_SUPERPOINTER = 4 # Any type with this or higher triggers special behavior when searching methods
                            # 4 - object id 0 as the superclass id, 5 - object id 1 as the superclass id, etc.
 
+QSIL_TAG_SMALLINTEGER = 0x80000000 # Pointer words with this bit set hold a SmallInteger, not an object id
+SMALLINTEGER_MIN = -(1 << 30)
+SMALLINTEGER_MAX = (1 << 30) - 1
+
+OBJECT_HEADER = struct.Struct("<4i") # type, object id, class id, number of slots (or bytes)
+
+# Direct payloads (strings, bytecodes, ...) at least this long are kept as
+# read-only views into the mapped image rather than copied, so processes
+# loading the same image share them through the page cache. A memoryview
+# takes 184 bytes and a copy 33 plus its length, so views only save memory
+# from 152 bytes up and anything shorter is copied
+SHARED_PAYLOAD_MINIMUM = 152
+
+# Lazy loading offsets for ids that aren't waiting to be read in
+LAZY_NOT_IN_IMAGE = -1
+LAZY_MATERIALIZED = -2
+
+# Images from format 2 on start with IMAGE_MAGIC and then the format as a
+# <H (format 1 images have no header, they start with the object count)
+IMAGE_MAGIC = b'QSIL'
+IMAGE_SECTION_STRINGS = 0 # Other sections are named by the type of object they hold
+IMAGE_CODEC_RAW = 0
+IMAGE_CODEC_ZLIB = 1
+
 class Bytecode(object):
     PUSH_SELF  = 0 # Implemented
     PUSH_SUPER = 1 # Not implemented
@@ -38,18 +68,134 @@ class Bytecode(object):
 
     JUMP = 15 # Implemented
     JUMP_IF_TRUE = 16 # Implemented
+    JUMP_IF_FALSE = 25 # Implemented
 
     BECOME_ACTIVECONTEXT = 17 # Implemented
 
     ALLOC_NEW = 18 # Implemented
     ALLOC_NEW_WITHSIZE = 19 # Implemented
 
+    PUSH_THISCONTEXT = 20 # Implemented
+
+    # Blocks that use self, the variables around them or ^ get a copy
+    # bound to the running context. Clean ones are pushed with PUSH_LITERAL
+    PUSH_CLOSURE = 26 # Implemented
+
+    # Superinstructions, see SUPERINSTRUCTIONS
+    SEND_LITERAL = 21 # Implemented
+    RETURN_SELF = 22 # Implemented
+    STORE_TEMP_POP = 24 # Implemented
+
+    # Sends of the selectors in SPECIAL_SELECTORS, one bytecode each
+    SEND_SPECIAL = 32 # Implemented, up to 44
+
     # 1,2, skip a few, primitives for math stuff
     PRIM_ADD = 64 # Implemented
 
-specials = [b'+', b',' b'-', b'/', b'*', b'>',
+    # Primitives for the memory system
+    PRIM_COLLECT_GARBAGE = 80 # Implemented
+    PRIM_GC_STATS = 81 # Implemented
+    PRIM_SNAPSHOT = 82 # Implemented
+    PRIM_SNAPSHOT_CHANGES = 83 # Implemented
+
+# Bytes of operand that follow each bytecode taking one
+BYTECODE_OPERAND_SIZES = {
+    Bytecode.PUSH_LITERAL: 1,
+    Bytecode.PUSH_ARG: 1,
+    Bytecode.PUSH_TEMP: 1,
+    Bytecode.PUSH_INSTVAR: 1,
+    Bytecode.POP_INTO_TEMP: 1,
+    Bytecode.POP_INTO_INSTVAR: 1,
+    Bytecode.PUSH_OBJ_REF: 4,
+    Bytecode.JUMP: 4,
+    Bytecode.JUMP_IF_TRUE: 4,
+    Bytecode.JUMP_IF_FALSE: 4,
+    Bytecode.SEND_LITERAL: 1,
+    Bytecode.STORE_TEMP_POP: 1,
+    Bytecode.PUSH_CLOSURE: 1,
+}
+
+JUMP_BYTECODES = (Bytecode.JUMP, Bytecode.JUMP_IF_TRUE, Bytecode.JUMP_IF_FALSE)
+
+# Pairs of bytecodes the bootstrapper replaces with one that does both,
+# taking the first one's operand (the second never has one). Picked with
+# qsilngrams.py
+SUPERINSTRUCTIONS = {
+    (Bytecode.PUSH_LITERAL, Bytecode.CALL): Bytecode.SEND_LITERAL,
+    (Bytecode.PUSH_SELF, Bytecode.RETURN): Bytecode.RETURN_SELF,
+    (Bytecode.POP_INTO_TEMP, Bytecode.POP): Bytecode.STORE_TEMP_POP,
+}
+
+specials = [b'+', b',', b'-', b'/', b'*', b'>',
             b'<', b'<=',b'>=', b'=', b'~=', b'==',
-            b'~==', b'&&', b'||', b'\\']
+            b'~==', b'&&', b'||', b'\\', b'%', b'//']
+
+class Primitive(object):
+    # Numbers for a method's <primitive: n>, the same as Squeak's
+    # where there's an equivalent
+    ADD = 1
+    SUBTRACT = 2
+    LESS_THAN = 3
+    GREATER_THAN = 4
+    LESS_OR_EQUAL = 5
+    GREATER_OR_EQUAL = 6
+    EQUAL = 7
+    NOT_EQUAL = 8
+    MULTIPLY = 9
+    EXACT_DIVIDE = 10
+    MOD = 11
+    DIVIDE = 12
+
+    AT = 60
+    AT_PUT = 61
+    SIZE = 62
+
+    BASIC_NEW = 70
+    BASIC_NEW_WITHSIZE = 71
+
+    IDENTICAL = 110
+
+def exactDivide(a, b):
+    # There are no Fractions, so / only answers when it divides exactly
+    return a // b if a % b == 0 else None
+
+# Integer primitive -> what it does to the two values. Results that are
+# bools answer true or false
+INTEGER_PRIMITIVES = {
+    Primitive.ADD: operator.add,
+    Primitive.SUBTRACT: operator.sub,
+    Primitive.LESS_THAN: operator.lt,
+    Primitive.GREATER_THAN: operator.gt,
+    Primitive.LESS_OR_EQUAL: operator.le,
+    Primitive.GREATER_OR_EQUAL: operator.ge,
+    Primitive.EQUAL: operator.eq,
+    Primitive.NOT_EQUAL: operator.ne,
+    Primitive.MULTIPLY: operator.mul,
+    Primitive.EXACT_DIVIDE: exactDivide,
+    Primitive.MOD: operator.mod,
+    Primitive.DIVIDE: operator.floordiv,
+}
+
+METHOD_PRIMITIVE = 6 # Slot of a Method holding its primitive number, if it has that slot
+
+# Selectors the bootstrapper sends with their own bytecode (SEND_SPECIAL
+# plus the index here) instead of PUSH_LITERAL and CALL. The primitive is
+# tried first, and the selector is only really sent if it fails
+SPECIAL_SELECTORS = [
+    (b'+', Primitive.ADD),
+    (b'-', Primitive.SUBTRACT),
+    (b'<', Primitive.LESS_THAN),
+    (b'>', Primitive.GREATER_THAN),
+    (b'<=', Primitive.LESS_OR_EQUAL),
+    (b'>=', Primitive.GREATER_OR_EQUAL),
+    (b'=', Primitive.EQUAL),
+    (b'~=', Primitive.NOT_EQUAL),
+    (b'*', Primitive.MULTIPLY),
+    (b'/', Primitive.EXACT_DIVIDE),
+    (b'%', Primitive.MOD),
+    (b'//', Primitive.DIVIDE),
+    (b'==', Primitive.IDENTICAL),
+]
 
 class VisibilityTypes(object):
     # Bit 1 - Prevents subclasses from accessing
@@ -82,22 +228,15 @@ class SpecialIDs(object):
 
     numObjs = 19
 
-class QSILObject(ctypes.Structure):
-    _pack_ = 1
-    _fields_ = [
-        ('type', ctypes.c_uint8),
-        ('objId', ctypes.c_uint32)
-    ]
-    def __init__(self, *args, **kwargs):
-        super(QSILObject, self).__init__(*args, **kwargs)
-        self.interp = None
-        self._cachedself = None
+class QSILObject(object):
+    # Plain __slots__ classes keep objects small (no per-instance
+    # __dict__) and make attribute access a simple slot lookup
+    __slots__ = ('type', 'objId', 'interp')
 
-    @property
-    def u(self):
-        if self._cachedself is None:
-            self._cachedself = self.interp.objects[self.objId]
-        return self._cachedself
+    def __init__(self):
+        self.type = QSIL_TYPE_POINTER
+        self.objId = 0
+        self.interp = None
 
     @property
     def ptr(self):
@@ -112,17 +251,24 @@ class QSILObject(ctypes.Structure):
         return self.u._superclass
 
 class Pointer(QSILObject):
-    _pack_ = 1
-    _fields_ = [
-    ]
-    def __init__(self, *args, **kwargs):
-        super(Pointer, self).__init__(*args, **kwargs)
+    # Pointers are only used while building and reading images. Once an
+    # image is loaded, slots refer to their objects directly
+    # (see Interpreter.resolveSlots)
+    __slots__ = ('_cachedself',)
 
-        self.type = QSIL_TYPE_POINTER
+    def __init__(self):
+        super(Pointer, self).__init__()
+        self._cachedself = None
 
     def __repr__(self):
         return f'[Pointer id {self.objId}]'
 
+    @property
+    def u(self):
+        if self._cachedself is None:
+            self._cachedself = self.interp.objects[self.objId]
+        return self._cachedself
+
     def copy(self):
         ret = Pointer()
         ret.interp = self.interp
@@ -142,62 +288,291 @@ class Pointer(QSILObject):
         output += struct.pack("<2i", self.type, self.objId)
         return output
 
+def pointerForWord(word, interp=None):
+    # What a pointer word read from an image stands for until it's resolved
+    if word & QSIL_TAG_SMALLINTEGER:
+        return SmallInteger.fromWord(word)
+    ptr = Pointer()
+    ptr.interp = interp
+    ptr.objId = word
+    return ptr
+
+class SmallInteger(object):
+    """
+    An Integer stored directly in a pointer slot instead of on the heap.
+    In the image it's a pointer word with QSIL_TAG_SMALLINTEGER set and
+    the value in the low 31 bits.
+    """
+    __slots__ = ('value',)
+    type = QSIL_TYPE_DIRECTOBJECT
+    classId = SpecialIDs.INTEGER_CLASS_ID
+    cache = []
+
+    def __init__(self, value):
+        self.value = value
+
+    def __repr__(self):
+        return f'[SmallInteger {self.value}]'
+
+    def __eq__(self, other):
+        if isinstance(other, SmallInteger):
+            return self.value == other.value
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(self.value)
+
+    @classmethod
+    def forValue(cls, value):
+        if -128 <= value < 1024:
+            return cls.cache[value + 128]
+        return cls(value)
+
+    @classmethod
+    def fromWord(cls, word):
+        value = word & 0x7fffffff
+        if value & 0x40000000:
+            value -= 0x80000000
+        return cls.forValue(value)
+
+    @staticmethod
+    def canHold(num):
+        return isinstance(num, int) and SMALLINTEGER_MIN <= num <= SMALLINTEGER_MAX
+
+    @property
+    def word(self):
+        return (self.value & 0x7fffffff) | QSIL_TAG_SMALLINTEGER
+
+    @property
+    def objId(self):
+        return self.word
+
+    @property
+    def u(self):
+        return self
+
+    @property
+    def pyObjStorage(self):
+        # Same bytes a boxed Integer would hold
+        return struct.pack("<i", self.value)
+
+SmallInteger.cache = [SmallInteger(value) for value in range(-128, 1024)]
+
+# Bytes an object takes up in an image: a 16 byte header, then its raw
+# bytes or 4 bytes per slot
+def imageSize(anObj):
+    if anObj.type == QSIL_TYPE_DIRECTOBJECT:
+        return 16 + len(anObj.pyObjStorage)
+    return 16 + 4 * len(anObj.pyObjStorage)
+
+def imageVersion(image):
+    if image[:len(IMAGE_MAGIC)] == IMAGE_MAGIC:
+        return struct.unpack_from("<H", image, len(IMAGE_MAGIC))[0]
+    return 1
+
+def writeVarint(buffer, value):
+    # 7 bits at a time, lowest first, with the top bit set on all but the last byte
+    while value > 0x7f:
+        buffer.append((value & 0x7f) | 0x80)
+        value >>= 7
+    buffer.append(value)
+
+def readVarint(data, offset):
+    value = 0
+    shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+
+def writeImageV2(stream, objs, contextObjId, compress=False):
+    # Format 2 is IMAGE_MAGIC, the format (<H), then varints for the number
+    # of objects, the active context's id and the number of sections. Next
+    # is the section index, one (kind <B, codec <B, then varints for the
+    # number of entries, stored length and raw length) per section, and
+    # then the sections themselves in the same order.
+    #
+    # The string table holds every distinct direct payload once, each a
+    # varint length and the bytes. The other sections hold one kind of
+    # object each, as varints: the id (less the previous one in the
+    # section, so objs must be in id order), the class id, and then either
+    # the payload's index in the string table or the number of slots and
+    # the slots. A slot is an object id shifted left by one, or a
+    # zigzagged SmallInteger shifted left by one with the low bit set
+    strings = {}
+    sections = {kind: bytearray() for kind in (QSIL_TYPE_POINTEROBJECT, QSIL_TYPE_DIRECTOBJECT, QSIL_TYPE_DIRECTPOINTEROBJECT)}
+    counts = dict.fromkeys(sections, 0)
+    lastIds = dict.fromkeys(sections, 0)
+    for obj in objs:
+        objType = obj.type
+        section = sections[objType]
+        writeVarint(section, obj.objId - lastIds[objType])
+        writeVarint(section, obj.classId)
+        lastIds[objType] = obj.objId
+        counts[objType] += 1
+        storage = obj.pyObjStorage
+        if objType == QSIL_TYPE_DIRECTOBJECT:
+            writeVarint(section, strings.setdefault(bytes(storage), len(strings)))
+        else:
+            writeVarint(section, len(storage))
+            for item in storage:
+                if item.__class__ is SmallInteger:
+                    value = item.value
+                    writeVarint(section, (((value << 1) ^ (value >> 63)) << 1) | 1)
+                else:
+                    writeVarint(section, item.objId << 1)
+
+    stringTable = bytearray()
+    for payload in strings:
+        writeVarint(stringTable, len(payload))
+        stringTable += payload
+    sectionList = [(IMAGE_SECTION_STRINGS, len(strings), stringTable)]
+    sectionList.extend((kind, counts[kind], section) for kind, section in sections.items())
+
+    header = bytearray(IMAGE_MAGIC + struct.pack("<H", 2))
+    writeVarint(header, sum(counts.values()))
+    writeVarint(header, contextObjId)
+    writeVarint(header, len(sectionList))
+    storedSections = []
+    for kind, count, section in sectionList:
+        stored, codec = section, IMAGE_CODEC_RAW
+        if compress:
+            compressed = zlib.compress(section, 9)
+            if len(compressed) < len(section):
+                stored, codec = compressed, IMAGE_CODEC_ZLIB
+        header += struct.pack("<BB", kind, codec)
+        writeVarint(header, count)
+        writeVarint(header, len(stored))
+        writeVarint(header, len(section))
+        storedSections.append(stored)
+    stream.write(header)
+    for stored in storedSections:
+        stream.write(stored)
+
+def bytecodeInstructions(bytecodes):
+    # Split bytecodes into (pc, bytecode, operand bytes) instructions,
+    # from the start
+    numBytecodes = len(bytecodes)
+    pc = 0
+    while pc < numBytecodes:
+        bc = bytecodes[pc]
+        nextPc = pc + 1 + BYTECODE_OPERAND_SIZES.get(bc, 0)
+        yield pc, bc, bytes(bytecodes[pc + 1:nextPc])
+        pc = nextPc
+
+def decodeBytecodes(bytecodes):
+    # Pre-decode bytecodes into a list, indexed by pc, of (bytecode,
+    # operand, pc of the next instruction). Every pc gets an entry, not
+    # just the ones instructions start at, so jump targets index it as
+    # they are and pcs stay byte offsets (which is what contexts, inline
+    # caches and images hold). The extra entry at the end is the end of
+    # the block, -1. An operand is the byte after a one byte operand
+    # bytecode, the target of a jump, or the object id (or SmallInteger)
+    # PUSH_OBJ_REF pushes. Reading past the end gives -1, like peekBc
+    numBytecodes = len(bytecodes)
+    def byteAt(pc):
+        return bytecodes[pc] if pc < numBytecodes else -1
+    code = []
+    for pc in range(numBytecodes):
+        bc = bytecodes[pc]
+        operandSize = BYTECODE_OPERAND_SIZES.get(bc, 0)
+        if operandSize == 1:
+            operand = byteAt(pc + 1)
+        elif operandSize == 4:
+            operand = sum(byteAt(pc + 1 + i) << (i * 8) for i in range(4))
+            if bc == Bytecode.PUSH_OBJ_REF and operand & QSIL_TAG_SMALLINTEGER:
+                operand = SmallInteger.fromWord(operand)
+        else:
+            operand = None
+        code.append((bc, operand, pc + 1 + operandSize))
+    code.append((-1, None, numBytecodes))
+    return code
+
+NO_CODE = decodeBytecodes(b'')
+
+# What Interpreter.run handles itself rather than through the dispatch table
+RUN_INLINED_BYTECODES = frozenset([
+    Bytecode.PUSH_SELF, Bytecode.PUSH_NIL, Bytecode.PUSH_TRUE, Bytecode.PUSH_FALSE,
+    Bytecode.PUSH_LITERAL, Bytecode.PUSH_ARG, Bytecode.PUSH_TEMP, Bytecode.PUSH_INSTVAR,
+    Bytecode.POP, Bytecode.POP_INTO_TEMP, Bytecode.POP_INTO_INSTVAR,
+    Bytecode.JUMP, Bytecode.JUMP_IF_TRUE, Bytecode.JUMP_IF_FALSE, Bytecode.PRIM_ADD,
+    Bytecode.STORE_TEMP_POP,
+] + list(range(Bytecode.SEND_SPECIAL, Bytecode.SEND_SPECIAL + len(SPECIAL_SELECTORS))))
+
+def integerValue(anInteger):
+    # Works for both SmallIntegers and boxed Integer objects
+    if isinstance(anInteger, SmallInteger):
+        return anInteger.value
+    return struct.unpack("<i", anInteger.u.pyObjStorage)[0]
+
 class Object(QSILObject):
-    _pack_ = 1
-    _fields_ = [
-        ('classId', ctypes.c_uint32)
-    ]
-    def __init__(self, *args, **kwargs):
-        super(Object, self).__init__(*args, **kwargs)
+    # frame is only ever set on contexts, for the Frame running them
+    __slots__ = ('classId', 'pyObjStorage', 'frame')
+
+    def __init__(self):
+        super(Object, self).__init__()
 
         self.type = QSIL_TYPE_POINTEROBJECT
-        # Need something resizable due to ctypes limitations
+        self.classId = 0
         self.pyObjStorage = []
 
     def setMem(self, memory):
         self.pyObjStorage = memory
 
+    def writableStorage(self):
+        # A direct object's payload may be a read-only view into the image,
+        # so it's copied the first time something wants to change it
+        if self.type == QSIL_TYPE_DIRECTOBJECT and not isinstance(self.pyObjStorage, bytearray):
+            self.pyObjStorage = bytearray(self.pyObjStorage)
+        return self.pyObjStorage
+
+    def __getattr__(self, name):
+        # Only called for slots that haven't been set. Objects from a lazily
+        # read image are shells with just an id until one of these is used
+        if name in ('type', 'classId', 'pyObjStorage') and self.interp is not None and self.interp.materialize(self):
+            return getattr(self, name)
+        raise AttributeError(name)
+
     def __repr__(self):
-        return f'[Object id {self.objId} classid {self.classId} storage {self.pyObjStorage}]'
+        storage = self.pyObjStorage
+        if self.type != QSIL_TYPE_DIRECTOBJECT:
+            # Referenced objects are shown by id, the graph is usually cyclic
+            storage = [f'[Ref id {item.objId}]' if isinstance(item, Object) else item for item in storage]
+        return f'[Object id {self.objId} classid {self.classId} storage {storage}]'
     
     def bytesForSerialization(self):
-        output = b''
-        output += struct.pack("<4i", self.type, self.objId, self.classId, len(self.pyObjStorage))
-        storageType = ''
-
-        for item in self.pyObjStorage:
-            if isinstance(item, Pointer):
-                assert (storageType or 'pointer') == 'pointer'
-                storageType = 'pointer'
-                output += struct.pack("<i", item.objId)
-            else:
-                assert (storageType or 'direct') == 'direct'
-                storageType = 'direct'
-                if isinstance(item, int):
-                    item = bytes([item])
-                output += item
-        return output
-    
+        output = io.BytesIO()
+        self.writeTo(output)
+        return output.getvalue()
+
+    def writeTo(self, stream):
+        # Header, then either the raw bytes or one word per slot
+        storage = self.pyObjStorage
+        stream.write(OBJECT_HEADER.pack(self.type, self.objId, self.classId, len(storage)))
+        if self.type == QSIL_TYPE_DIRECTOBJECT:
+            stream.write(storage)
+        else:
+            stream.write(struct.pack(f"<{len(storage)}I",
+                                     *[item.word if item.__class__ is SmallInteger else item.objId for item in storage]))
+
     @classmethod
     def readFrom(cls, stream, interp=None):
+        # Read one object written by writeTo. Its slots are SmallIntegers
+        # and Pointers, see Interpreter.resolvePointers
         ret = cls()
         ret.interp = interp
-        ret.type, ret.objId, ret.classId, numObjs = struct.unpack("<4i", stream.read(16))
+        ret.type, ret.objId, ret.classId, size = OBJECT_HEADER.unpack(stream.read(OBJECT_HEADER.size))
         if ret.type == QSIL_TYPE_DIRECTOBJECT:
-            ret.setMem(stream.read(numObjs))
-        elif ret.type in [QSIL_TYPE_POINTEROBJECT, QSIL_TYPE_DIRECTPOINTEROBJECT]:
-            objs = []
-            for _ in range(numObjs):
-                ptr = Pointer()
-                ptr.interp = interp
-                ptr.objId = struct.unpack("<i", stream.read(4))[0]
-                objs.append(ptr)
-            ret.setMem(objs)
+            ret.setMem(stream.read(size))
+        elif ret.type == QSIL_TYPE_POINTEROBJECT or ret.type == QSIL_TYPE_DIRECTPOINTEROBJECT:
+            ret.setMem([pointerForWord(word, interp) for word in struct.unpack(f"<{size}I", stream.read(4 * size))])
         else:
-            print("unknown")
-            raise RuntimeError("Here")
+            raise RuntimeError("Unknown object type {} for object {}".format(ret.type, ret.objId))
         return ret
-
+    
     @property
     def _class(self):
         return self.interp.objects[self.classId]
@@ -213,80 +588,789 @@ class Object(QSILObject):
     def u(self):
         return self
 
+class Frame(object):
+    """
+    A method or block activation. The interpreter runs frames directly and
+    only turns one into a MethodContext/BlockContext object when it has to
+    be seen as an object (see Interpreter.reifyFrame).
+    """
+    __slots__ = ('pc', 'stack', 'receiver', 'temps', 'parent', 'args', 'method',
+                 'literals', 'bytecodes', 'code', 'codeId', 'home', 'context', 'isBlock', 'block')
+
+    def __init__(self):
+        self.pc = 0
+        self.stack = []
+        self.receiver = None
+        self.temps = []
+        self.parent = None # Frame, or None to use the context's parentContext
+        self.args = []
+        self.method = None
+        self.literals = []
+        self.bytecodes = b''
+        self.code = NO_CODE # bytecodes, pre-decoded (see decodeBytecodes)
+        self.codeId = None
+        self.home = None
+        self.context = None # The reified context object, if there is one
+        self.isBlock = False
+        self.block = None # The BlockContext a block frame runs
+
+    def __repr__(self):
+        kind = 'block' if self.isBlock else 'method'
+        return f'[Frame {kind} code {self.codeId} pc {self.pc} stack {self.stack}]'
+
+class InlineCache(object):
+    """
+    Remembers the receiver classes seen at a single CALL site and the
+    method each of them resolved to.
+    """
+    def __init__(self, limit):
+        self.limit = limit
+        self.entries = [] # (method cache key, method) pairs
+        self.megamorphic = False
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return f'[InlineCache {self.state} entries {len(self.entries)} hits {self.hits} misses {self.misses}]'
+
+    @property
+    def state(self):
+        if self.megamorphic:
+            return 'megamorphic'
+        elif not self.entries:
+            return 'empty'
+        elif len(self.entries) == 1:
+            return 'monomorphic'
+        return 'polymorphic'
+
+    def lookup(self, key):
+        if not self.megamorphic:
+            for entryKey, method in self.entries:
+                if entryKey == key:
+                    self.hits += 1
+                    return method
+        self.misses += 1
+        return None
+
+    def add(self, key, method):
+        if self.megamorphic:
+            return
+        if len(self.entries) >= self.limit:
+            # Too many receiver classes here, stop caching at this site
+            # and let the global method cache handle it
+            self.entries = []
+            self.megamorphic = True
+            return
+        self.entries.append((key, method))
+
+    def flush(self, selectorName=None):
+        if selectorName is None:
+            self.entries = []
+        else:
+            self.entries = [entry for entry in self.entries if entry[0][1] != selectorName]
+
+class ObjectTable(list):
+    """
+    The object table maps object ids to objects. Ids index straight into
+    the list, and ids freed by the garbage collector are handed out again
+    before the table grows, so ids stay dense without renumbering.
+    Free and reserved slots hold None.
+    """
+    def __init__(self):
+        super(ObjectTable, self).__init__()
+        self.freeIds = []
+
+    def load(self, objs):
+        # Place objects read from an image at their own ids. Ids the image
+        # skipped (other than the special ones) become free slots
+        highestId = max((obj.objId for obj in objs), default=-1)
+        self[:] = [None] * max(highestId + 1, SpecialIDs.numObjs)
+        for obj in objs:
+            self[obj.objId] = obj
+        self.freeIds = [objId for objId in range(len(self) - 1, SpecialIDs.numObjs - 1, -1) if self[objId] is None]
+
+    def allocate(self):
+        # Reserve an id, reusing the most recently freed one if there is one
+        if self.freeIds:
+            return self.freeIds.pop()
+        self.append(None)
+        return len(self) - 1
+
+    def free(self, objId):
+        self[objId] = None
+        self.freeIds.append(objId)
+
+    def compact(self, canMove):
+        # Move objects from the top of the table down into the lowest free
+        # slots, then shrink it. Returns {old id: new id} for what moved
+        moved = {}
+        holes = sorted(self.freeIds)
+        freeIds = set(holes)
+        top = len(self) - 1
+        for hole in holes:
+            while top > hole and (top in freeIds or not canMove(self[top])):
+                top -= 1
+            if top <= hole:
+                break
+            obj = self[top]
+            self[hole] = obj
+            obj.objId = hole
+            self[top] = None
+            freeIds.discard(hole)
+            freeIds.add(top)
+            moved[top] = hole
+            top -= 1
+        self.freeIds = sorted(freeIds, reverse=True)
+        self.shrink()
+        return moved
+
+    def shrink(self):
+        # Drop free slots at the end of the table
+        freeIds = set(self.freeIds)
+        end = len(self)
+        while end > SpecialIDs.numObjs and end - 1 in freeIds:
+            end -= 1
+        if end < len(self):
+            del self[end:]
+            self.freeIds = [objId for objId in self.freeIds if objId < end]
+
+    def liveCount(self):
+        return len(self) - len(self.freeIds)
+
+    def get(self, objId, default=None):
+        if 0 <= objId < len(self):
+            obj = self[objId]
+            if obj is not None:
+                return obj
+        return default
+
+    def ids(self):
+        return [objId for objId, obj in enumerate(self) if obj is not None]
+
+    def values(self):
+        return [obj for obj in self if obj is not None]
+
+    def items(self):
+        return [(objId, obj) for objId, obj in enumerate(self) if obj is not None]
+
+    @property
+    def highestId(self):
+        return len(self) - 1
+
+    def stats(self):
+        # Occupancy is the share of slots in use. Fragmentation is the share
+        # of slots that are free but sit below the highest id in use, so
+        # can't be given back by shrinking the table
+        capacity = len(self)
+        free = len(self.freeIds)
+        used = capacity - free
+        highestUsed = capacity - 1
+        freeIds = set(self.freeIds)
+        while highestUsed >= 0 and highestUsed in freeIds:
+            highestUsed -= 1
+        holes = sum(1 for objId in self.freeIds if objId < highestUsed)
+        return {
+            'capacity': capacity,
+            'used': used,
+            'free': free,
+            'occupancy': used / capacity if capacity else 1.0,
+            'fragmentation': holes / capacity if capacity else 0.0,
+        }
+
+class LazyObjectTable(ObjectTable):
+    """
+    The object table while an image is being read in lazily. Slots for
+    image objects nothing has looked up yet hold None, and looking one up
+    puts an empty shell object there (see Interpreter.materialize), so
+    untouched objects cost nothing beyond their offset in the index.
+    """
+    def __init__(self, interp, offsets):
+        super(LazyObjectTable, self).__init__()
+        self.interp = interp
+        self.offsets = offsets
+
+    def __getitem__(self, objId):
+        obj = list.__getitem__(self, objId)
+        if obj is None and objId < len(self.offsets) and self.offsets[objId] >= 0:
+            obj = Object.__new__(Object)
+            obj.objId = objId
+            obj.interp = self.interp
+            self[objId] = obj
+        return obj
+
 class Interpreter(object):
     """
     The interpreter interprets the bytecodes that QSIL runs on.
     """
     def __init__(self):
-        self.activeContext = None
-        self.objects = {}
+        self.activeFrame = None
+        self.objects = ObjectTable()
         self.activeObjects = []
-        self.highestId = 0
-        self.consolidationCounter = 10000
+        # Young generation: ids of objects allocated since the last
+        # collection, and the old objects that may refer to them
+        self.nursery = set()
+        self.nurseryBytes = 0
+        self.rememberedSet = set()
+
+        # Collection policy. A scavenge runs once the nursery holds
+        # nurseryObjectLimit objects or nurseryByteLimit bytes. A full
+        # collection runs once more than fullGcThreshold objects are live,
+        # and the threshold is then reset to gcGrowthFactor times whatever
+        # survived (but never below fullGcMinimum)
+        self.nurseryObjectLimit = 1000
+        self.nurseryByteLimit = 256 * 1024
+        self.fullGcMinimum = 20000
+        self.fullGcThreshold = self.fullGcMinimum
+        self.gcGrowthFactor = 2.0
+        self.gcPending = False
+
+        # GC telemetry, see gcStats()
+        self.gcCycles = {'full': 0, 'minor': 0}
+        self.gcTotalPause = 0.0
+        self.gcTotalFreed = 0
+        self.gcTotalBytesFreed = 0
+        self.gcPauseBuckets = [0.0001, 0.001, 0.01, 0.1] # Upper bounds (seconds) of the pause histogram
+        self.gcPauseHistogram = [0] * (len(self.gcPauseBuckets) + 1)
+        self.gcHistory = [] # One dict per cycle, for the last gcHistoryLength cycles
+        self.gcHistoryLength = 100
+
+        # Snapshots. snapshotDirty holds the ids of objects made or changed
+        # since the last snapshot (None until there's been one), and
+        # snapshotIds marks which ids that snapshot wrote
+        self.snapshotFile = None
+        self.snapshotDirty = None
+        self.snapshotIds = None
+        self.snapshotStats = None
+        self.dispatchTable = self.buildDispatchTable()
+        self.primitiveTable = self.buildPrimitiveTable()
+        # SEND_SPECIAL bytecode -> its selector's primitive
+        self.specialSends = {Bytecode.SEND_SPECIAL + index: self.primitiveTable[primitive]
+                             for index, (_, primitive) in enumerate(SPECIAL_SELECTORS)}
+
+        # (class id, selector, static?) -> method
+        self.methodCache = {}
+        self.methodCacheHits = 0
+        self.methodCacheMisses = 0
+
+        # (code object id, pc of the CALL) -> InlineCache
+        self.inlineCaches = {}
+        self.inlineCacheLimit = 4
+
+        # bytecodes -> pre-decoded code, see decodedCode
+        self.codeCache = {}
+
+        # Set once an image is loaded
+        self.loadStats = None # Size and timing of the last readFile
+        self.image = None # The mapped image, which shared payloads and lazily read objects come from
+        self.imageView = None
+        self.sharedPayloadBytes = 0
+        self.lazyOffsets = None # Object id -> offset in image (or one of the LAZY_ values) while reading lazily
+        self.lazyMaterialized = 0
+        self.nilObject = None
+        self.trueObject = None
+        self.falseObject = None
 
         # Cached for speed
         self.bytecodes = None
+        self.code = None
+        self.codeId = None # Object id of the method or block bytecodes being run
         self.pc = None
     
-    def readFile(self, fileName):
+    def readFile(self, fileName, lazy=False):
+        # With lazy, only an index of where each object sits in the image is
+        # built up front, and objects are read in when first used (see materialize)
+        startTime = time.perf_counter()
         with open(fileName, "rb") as inputFile:
-            numObjects = struct.unpack("<i", inputFile.read(4))[0]
+            image = mmap.mmap(inputFile.fileno(), 0, access=mmap.ACCESS_READ)
+        # Stays mapped for as long as the interpreter runs
+        self.image = image
+        self.imageView = memoryview(image)
+        self.sharedPayloadBytes = 0
+        version = imageVersion(image)
+        if version == 2:
+            # Nothing in a format 2 image can be used without decoding it
+            # first, so it's always read in up front
+            lazy = False
+            numObjects, contextObjId = self.loadImageV2(image)
+        elif version != 1:
+            raise RuntimeError("Unsupported image format {} in {}".format(version, fileName))
+        elif lazy:
+            numObjects, contextObjId = self.indexImage(image)
+        else:
+            numObjects, contextObjId = self.loadImage(image)
+        imageSize = len(image)
+        loadTime = time.perf_counter() - startTime
+        self.loadStats = {
+            'objects': numObjects,
+            'bytes': imageSize,
+            'seconds': loadTime,
+            'objects per second': numObjects / loadTime if loadTime else 0.0,
+            'MB per second': imageSize / loadTime / 1000000 if loadTime else 0.0,
+            'format': version,
+            'lazy': lazy,
+            'shared payload bytes': self.sharedPayloadBytes,
+        }
+
+        self.flushMethodCache()
+        self.setActiveContext(self.objects[contextObjId])
+
+    def loadImage(self, image):
+        # Decode every object in an image buffer into the object table.
+        # Returns the number of objects and the id of the active context.
+        # This is the hot loop at startup, so objects are built without
+        # going through Object.__init__
+        objsById = {}
+        readHeader = OBJECT_HEADER.unpack_from
+        newObject = Object.__new__
+        imageView = self.imageView
+        sharedPayloadBytes = 0
+        offset = 0
+        contextObjId = None
+        # The base image may be followed by delta segments written by
+        # snapshot, each replacing the objects it holds
+        while offset < len(image):
+            numObjects = struct.unpack_from("<i", image, offset)[0]
+            offset += 4
+            for _ in range(numObjects):
+                objType, objId, classId, size = readHeader(image, offset)
+                offset += 16
+                newObj = newObject(Object)
+                newObj.type = objType
+                newObj.objId = objId
+                newObj.classId = classId
+                newObj.interp = self
+                if objType == QSIL_TYPE_DIRECTOBJECT:
+                    # Symbols are hashed and compared on every send, so they're
+                    # always copied
+                    if size >= SHARED_PAYLOAD_MINIMUM and classId != SpecialIDs.SYMBOL_CLASS_ID:
+                        newObj.pyObjStorage = imageView[offset:offset + size]
+                        sharedPayloadBytes += size
+                    else:
+                        newObj.pyObjStorage = image[offset:offset + size]
+                    offset += size
+                elif objType == QSIL_TYPE_POINTEROBJECT or objType == QSIL_TYPE_DIRECTPOINTEROBJECT:
+                    # Raw words for now, see resolveSlots
+                    newObj.pyObjStorage = struct.unpack_from(f"<{size}I", image, offset)
+                    offset += 4 * size
+                else:
+                    raise RuntimeError("Unknown object type {} for object {}".format(objType, objId))
+                objsById[objId] = newObj
+            if contextObjId is not None:
+                freedIds, offset = self.readFreedIds(image, offset)
+                for objId in freedIds:
+                    objsById.pop(objId, None)
+            contextObjId = struct.unpack_from("<i", image, offset)[0]
+            offset += 4
+        self.sharedPayloadBytes = sharedPayloadBytes
+
+        objs = list(objsById.values())
+        self.objects.load(objs)
+        self.resolveSlots(objs)
+        return len(objs), contextObjId
+
+    def indexImage(self, image):
+        # Record where each object starts in the image, without reading
+        # any of them in. Returns the number of objects and the id of the
+        # active context
+        offsetsById = {}
+        readHeader = OBJECT_HEADER.unpack_from
+        offset = 0
+        contextObjId = None
+        while offset < len(image):
+            numObjects = struct.unpack_from("<i", image, offset)[0]
+            offset += 4
             for _ in range(numObjects):
-                newObj = Object.readFrom(inputFile, self)
-                self.objects[newObj.objId] = newObj
-                self.highestId = max((self.highestId, newObj.objId))
-            
-            contextObjId = struct.unpack("<i", inputFile.read(4))[0]
-            self.setActiveContext(self.objects[contextObjId])
+                objType, objId, classId, size = readHeader(image, offset)
+                offsetsById[objId] = offset
+                offset += 16 + (size if objType == QSIL_TYPE_DIRECTOBJECT else 4 * size)
+            if contextObjId is not None:
+                freedIds, offset = self.readFreedIds(image, offset)
+                for objId in freedIds:
+                    offsetsById.pop(objId, None)
+            contextObjId = struct.unpack_from("<i", image, offset)[0]
+            offset += 4
+
+        numIds = max(max(offsetsById, default=-1) + 1, SpecialIDs.numObjs)
+        self.lazyOffsets = array.array('q', [LAZY_NOT_IN_IMAGE]) * numIds
+        for objId, objOffset in offsetsById.items():
+            self.lazyOffsets[objId] = objOffset
+        self.lazyMaterialized = 0
+
+        self.objects = LazyObjectTable(self, self.lazyOffsets)
+        self.objects[:] = [None] * numIds
+        self.objects.freeIds = [objId for objId in range(numIds - 1, SpecialIDs.numObjs - 1, -1)
+                                if self.lazyOffsets[objId] == LAZY_NOT_IN_IMAGE]
+        self.setSpecialObjects()
+        return len(offsetsById), contextObjId
+
+    def loadImageV2(self, image):
+        # Decode a format 2 image (see writeImageV2) into the object table.
+        # Returns the number of objects and the id of the active context
+        offset = len(IMAGE_MAGIC) + 2
+        numObjects, offset = readVarint(image, offset)
+        contextObjId, offset = readVarint(image, offset)
+        numSections, offset = readVarint(image, offset)
+        index = []
+        for _ in range(numSections):
+            kind, codec = struct.unpack_from("<BB", image, offset)
+            count, offset = readVarint(image, offset + 2)
+            storedLength, offset = readVarint(image, offset)
+            rawLength, offset = readVarint(image, offset)
+            index.append((kind, codec, count, storedLength))
+        sections = []
+        for kind, codec, count, storedLength in index:
+            if codec == IMAGE_CODEC_ZLIB:
+                sections.append((kind, count, zlib.decompress(image[offset:offset + storedLength]), 0))
+            elif codec == IMAGE_CODEC_RAW:
+                sections.append((kind, count, image, offset))
+            else:
+                raise RuntimeError("Unknown section codec {}".format(codec))
+            offset += storedLength
+
+        strings = []
+        imageView = self.imageView
+        sharedPayloadBytes = 0
+        for kind, count, data, offset in sections:
+            if kind != IMAGE_SECTION_STRINGS:
+                continue
+            # Long payloads in an uncompressed table are shared with the
+            # mapped image, as in loadImage
+            for _ in range(count):
+                size, offset = readVarint(data, offset)
+                if data is image and size >= SHARED_PAYLOAD_MINIMUM:
+                    strings.append(imageView[offset:offset + size])
+                else:
+                    strings.append(bytes(data[offset:offset + size]))
+                offset += size
+
+        objs = []
+        newObject = Object.__new__
+        for kind, count, data, offset in sections:
+            if kind == IMAGE_SECTION_STRINGS:
+                continue
+            objId = 0
+            # Most varints here are a single byte, so that case is read inline
+            for _ in range(count):
+                idDelta = data[offset]
+                if idDelta < 0x80:
+                    offset += 1
+                else:
+                    idDelta, offset = readVarint(data, offset)
+                classId = data[offset]
+                if classId < 0x80:
+                    offset += 1
+                else:
+                    classId, offset = readVarint(data, offset)
+                objId += idDelta
+                newObj = newObject(Object)
+                newObj.type = kind
+                newObj.objId = objId
+                newObj.classId = classId
+                newObj.interp = self
+                if kind == QSIL_TYPE_DIRECTOBJECT:
+                    stringIndex, offset = readVarint(data, offset)
+                    payload = strings[stringIndex]
+                    if payload.__class__ is memoryview:
+                        if classId == SpecialIDs.SYMBOL_CLASS_ID:
+                            payload = bytes(payload)
+                        else:
+                            sharedPayloadBytes += len(payload)
+                    newObj.pyObjStorage = payload
+                elif kind == QSIL_TYPE_POINTEROBJECT or kind == QSIL_TYPE_DIRECTPOINTEROBJECT:
+                    # Back to format 1's raw words, see resolveSlots
+                    numSlots, offset = readVarint(data, offset)
+                    words = []
+                    for _ in range(numSlots):
+                        slot = data[offset]
+                        if slot < 0x80:
+                            offset += 1
+                        else:
+                            slot, offset = readVarint(data, offset)
+                        if slot & 1:
+                            slot >>= 1
+                            words.append(((slot >> 1) ^ -(slot & 1)) & 0x7fffffff | QSIL_TAG_SMALLINTEGER)
+                        else:
+                            words.append(slot >> 1)
+                    newObj.pyObjStorage = words
+                else:
+                    raise RuntimeError("Unknown object type {} for object {}".format(kind, objId))
+                objs.append(newObj)
+        self.sharedPayloadBytes = sharedPayloadBytes
+
+        self.objects.load(objs)
+        self.resolveSlots(objs)
+        return numObjects, contextObjId
+
+    def readFreedIds(self, image, offset):
+        # A delta segment lists the ids freed since the snapshot before it
+        numFreed = struct.unpack_from("<i", image, offset)[0]
+        offset += 4
+        return struct.unpack_from(f"<{numFreed}i", image, offset), offset + 4 * numFreed
+
+    def materialize(self, shell):
+        # Read a shell object in from the lazily read image. Returns False
+        # if there was nothing to read
+        objId = shell.objId
+        lazyOffsets = self.lazyOffsets
+        if lazyOffsets is None or not 0 <= objId < len(lazyOffsets) or lazyOffsets[objId] < 0:
+            return False
+        offset = lazyOffsets[objId]
+        lazyOffsets[objId] = LAZY_MATERIALIZED
+
+        image = self.image
+        objType, _, classId, size = OBJECT_HEADER.unpack_from(image, offset)
+        offset += OBJECT_HEADER.size
+        shell.type = objType
+        shell.classId = classId
+        if objType == QSIL_TYPE_DIRECTOBJECT:
+            if size >= SHARED_PAYLOAD_MINIMUM and classId != SpecialIDs.SYMBOL_CLASS_ID:
+                shell.pyObjStorage = self.imageView[offset:offset + size]
+                self.sharedPayloadBytes += size
+            else:
+                shell.pyObjStorage = image[offset:offset + size]
+        elif objType == QSIL_TYPE_POINTEROBJECT or objType == QSIL_TYPE_DIRECTPOINTEROBJECT:
+            objects = self.objects
+            numIds = len(objects)
+            shell.pyObjStorage = [objects[word] if word < numIds and objects[word] is not None else self.pointerForWord(word)
+                                  for word in struct.unpack_from(f"<{size}I", image, offset)]
+        else:
+            raise RuntimeError("Unknown object type {} for object {}".format(objType, objId))
+        self.lazyMaterialized += 1
+        return True
+
+    def materializeAll(self):
+        # Read in everything still waiting, which ends lazy loading
+        if self.lazyOffsets is None:
+            return
+        for objId, offset in enumerate(self.lazyOffsets):
+            if offset >= 0:
+                self.materialize(self.objects[objId])
+        objects = ObjectTable()
+        objects.extend(self.objects)
+        objects.freeIds = self.objects.freeIds
+        self.objects = objects
+        self.lazyOffsets = None
+
+    def imageObjects(self):
+        # Everything from a lazily read image that has been looked up so far
+        if self.lazyOffsets is None:
+            return []
+        # Iterating the table directly doesn't make shells
+        return [obj for obj, offset in zip(self.objects, self.lazyOffsets)
+                if obj is not None and offset != LAZY_NOT_IN_IMAGE]
+
+    def lazyLoadStats(self):
+        if self.lazyOffsets is None:
+            return None
+        return {
+            'objects': self.loadStats['objects'],
+            'materialized': self.lazyMaterialized,
+            'pending': sum(1 for offset in self.lazyOffsets if offset >= 0),
+        }
+
+    def resolveSlots(self, objs):
+        # Turn the raw words read from the image into SmallIntegers and
+        # the objects they refer to, so nothing in the running image needs
+        # an objects[] lookup. Ids with no object behind them are kept as
+        # Pointers
+        objects = self.objects
+        targets = [obj if obj is not None else self.pointerForWord(objId) for objId, obj in enumerate(objects)]
+        numIds = len(targets)
+        for obj in objs:
+            if obj.type != QSIL_TYPE_DIRECTOBJECT:
+                obj.pyObjStorage = [targets[word] if word < numIds else self.pointerForWord(word)
+                                    for word in obj.pyObjStorage]
+        self.setSpecialObjects()
+
+    def setSpecialObjects(self):
+        objects = self.objects
+        self.nilObject = objects[SpecialIDs.NIL_OBJECT_ID]
+        self.trueObject = objects[SpecialIDs.TRUE_OBJECT_ID]
+        self.falseObject = objects[SpecialIDs.FALSE_OBJECT_ID]
+
+    def pointerForWord(self, word):
+        return pointerForWord(word, self)
+
+    def resolvePointers(self):
+        # For objects read one at a time with Object.readFrom and put in
+        # the table with objects.load. readFile resolves as it loads
+        objects = self.objects
+        numIds = len(objects)
+        for obj in objects:
+            if obj is None or obj.type == QSIL_TYPE_DIRECTOBJECT:
+                continue
+            obj.pyObjStorage = [objects[item.objId] if item.__class__ is Pointer and item.objId < numIds and
+                                objects[item.objId] is not None else item for item in obj.pyObjStorage]
+        self.setSpecialObjects()
     
     def incrementPc(self):
         self.pc += 1
         return self.pc
 
     def nextObjectId(self):
-        # O(log(n)) algorithm
-        # ids = list(sorted(self.objects.keys()))
-        # start = 0
-        # end = len(ids) - 1
-        # while(start <= end):
-        #     mid = (start + end) // 2
-        #     if ids[mid] > mid:
-        #         result = mid - 1
-        #         end = mid - 1
-        #     else:
-        #         start = mid + 1
-        #         result = mid + 1
-        # nextId = result
-        self.highestId += 1
-        self.objects[self.highestId] = None
-        return self.highestId
+        objId = self.objects.allocate()
+        self.nursery.add(objId)
+        return objId
+
+    def addObject(self, anObj):
+        # Give a newly made object an id and account for it against the
+        # nursery budget. Collection itself waits for the next bytecode
+        # boundary, when everything live is reachable from the frames
+        anObj.objId = self.nextObjectId()
+        self.objects[anObj.objId] = anObj
+        if self.snapshotDirty is not None:
+            self.snapshotDirty.add(anObj.objId)
+        self.nurseryBytes += imageSize(anObj)
+        if len(self.nursery) >= self.nurseryObjectLimit or self.nurseryBytes >= self.nurseryByteLimit:
+            self.gcPending = True
+        return anObj
+
+    def objectTableStats(self):
+        return self.objects.stats()
+
+    def setActiveFrame(self, aFrame):
+        # Store the old PC on the current frame
+        oldFrame = self.activeFrame
+        if oldFrame is not None:
+            oldFrame.pc = self.pc
+            if oldFrame.context is not None:
+                # The frame's stack is also its context's stack collection,
+                # which nothing else watches once the frame isn't running
+                stackCollection = oldFrame.context.pyObjStorage[1]
+                self.rememberedSet.add(stackCollection)
+                if self.snapshotDirty is not None:
+                    self.snapshotDirty.add(stackCollection.objId)
+
+        self.activeFrame = aFrame
+        self.pc = aFrame.pc
+        self.bytecodes = aFrame.bytecodes
+        self.code = aFrame.code
+        self.codeId = aFrame.codeId
 
     def setActiveContext(self, aContext):
-        # Store the old PC on the current context
-        if self.activeContext:
-            pcPtr = self.activeContext.pyObjStorage[0].u
-            pcBytes = struct.pack("<i", self.pc)
-            pcPtr.pyObjStorage = pcBytes
-
-        self.activeContext = aContext
-        pcPtr = self.activeContext.pyObjStorage[0].u
-        pcBytes = pcPtr.pyObjStorage
-        self.pc = struct.unpack("<i", pcBytes)[0]
-
-        contextType = self.activeContext.classId
+        self.setActiveFrame(self.frameForContext(aContext))
+
+    @property
+    def activeContext(self):
+        return self.reifyFrame(self.activeFrame)
+
+    def frameForContext(self, aContext):
+        # The frame running a context object, making one if
+        # the context hasn't been run yet (e.g. it came from the image)
+        frame = getattr(aContext, 'frame', None)
+        if frame is not None:
+            return frame
+
+        contextType = aContext.classId
         if contextType == SpecialIDs.METHODCONTEXT_CLASS_ID:
-            method = self.activeContext.u.pyObjStorage[6].u
+            method = aContext.pyObjStorage[6]
             assert method.classId == SpecialIDs.METHOD_CLASS_ID
 
-            methodbytecodes = method.pyObjStorage[3].u
-            self.bytecodes = methodbytecodes.pyObjStorage
+            frame = Frame()
+            frame.stack = aContext.pyObjStorage[1].pyObjStorage
+            frame.receiver = aContext.pyObjStorage[2]
+            frame.temps = aContext.pyObjStorage[3].pyObjStorage
+            frame.args = aContext.pyObjStorage[5].pyObjStorage
+            frame.method = method
+            frame.literals = method.pyObjStorage[4].pyObjStorage
+            frame.bytecodes = method.pyObjStorage[3].pyObjStorage
+            frame.code = self.decodedCode(frame.bytecodes)
+            frame.codeId = method.objId
+            frame.context = aContext
         elif contextType == SpecialIDs.BLOCKCONTEXT_CLASS_ID:
-            blockBytecodes = self.activeContext.u.pyObjStorage[7].u
-            self.bytecodes = blockBytecodes.pyObjStorage
+            frame = self.frameForBlock(aContext)
         else:
-            self.prettyPrintObject(self.activeContext)
+            self.prettyPrintObject(aContext)
             raise RuntimeError("No bytecode available!")
-    
+        frame.pc = integerValue(aContext.pyObjStorage[0])
+        aContext.frame = frame
+        return frame
+
+    def frameForBlock(self, blockCtx):
+        blockBytecodes = blockCtx.pyObjStorage[7]
+
+        frame = Frame()
+        frame.stack = blockCtx.pyObjStorage[1].pyObjStorage
+        frame.receiver = blockCtx.pyObjStorage[2]
+        frame.temps = blockCtx.pyObjStorage[3].pyObjStorage
+        frame.args = blockCtx.pyObjStorage[5].pyObjStorage
+        frame.literals = blockCtx.pyObjStorage[6].pyObjStorage
+        frame.bytecodes = blockBytecodes.pyObjStorage
+        frame.code = self.decodedCode(frame.bytecodes)
+        frame.codeId = blockBytecodes.objId
+        frame.home = blockCtx.pyObjStorage[8]
+        frame.context = blockCtx
+        frame.isBlock = True
+        frame.block = blockCtx
+        return frame
+
+    def reifyFrame(self, frame, withParents=True):
+        # Make (or update) the MethodContext/BlockContext object for a frame
+        # and, withParents, for every frame it returns to, each linked to the
+        # next by its parentContext. A loop, as the chain can be any depth
+        ctx = self.reifyOneFrame(frame)
+        childCtx = ctx
+        while withParents and frame.parent is not None:
+            frame = frame.parent
+            parentCtx = self.reifyOneFrame(frame)
+            childCtx.pyObjStorage[4] = parentCtx
+            self.writeBarrier(childCtx, parentCtx)
+            childCtx = parentCtx
+        return ctx
+
+    def reifyOneFrame(self, frame):
+        # The context shares the frame's stack, temps and args, so only the
+        # pc needs to be copied across
+        if frame is self.activeFrame:
+            frame.pc = self.pc
+
+        ctx = frame.context
+        if ctx is None:
+            ctx = Object()
+            ctx.interp = self
+            if frame.isBlock:
+                # An activation of a clean block, which has its own
+                # stack and temps but otherwise is the block literal
+                block = frame.block.pyObjStorage
+                ctx.classId = SpecialIDs.BLOCKCONTEXT_CLASS_ID
+                ctx.setMem([SmallInteger.forValue(frame.pc), self.qsilOrderedCollectionPtr(frame.stack),
+                            frame.receiver, self.qsilOrderedCollectionPtr(frame.temps),
+                            self.nilObject, self.qsilOrderedCollectionPtr(frame.args),
+                            block[6], block[7], block[8]])
+            else:
+                ctx.classId = SpecialIDs.METHODCONTEXT_CLASS_ID
+                ctx.setMem([SmallInteger.forValue(frame.pc), self.qsilOrderedCollectionPtr(frame.stack),
+                            frame.receiver, self.qsilOrderedCollectionPtr(frame.temps),
+                            self.nilObject, self.qsilOrderedCollectionPtr(frame.args), frame.method])
+            self.addObject(ctx)
+
+            ctx.frame = frame
+            frame.context = ctx
+        else:
+            ctx.pyObjStorage[0] = SmallInteger.forValue(frame.pc)
+        return ctx
+
+    def parentFrame(self, frame):
+        if frame.parent is not None:
+            return frame.parent
+        if frame.context is None:
+            raise RuntimeError("No parent context!")
+        return self.frameForContext(frame.context.pyObjStorage[4])
+
+    def decodedCode(self, bytecodes):
+        # Bytecodes are decoded once and shared by every frame running them.
+        # The cache is keyed by the bytecodes themselves, so changed ones
+        # never find a stale entry. A payload that's been made writable (a
+        # bytearray, see Object.writableStorage) can't be a key and is
+        # decoded every time
+        try:
+            return self.codeCache[bytecodes]
+        except KeyError:
+            code = self.codeCache[bytecodes] = decodeBytecodes(bytecodes)
+            return code
+        except TypeError:
+            return decodeBytecodes(bytecodes)
+
     def setPc(self, newPc):
         self.pc = newPc
 
@@ -298,16 +1382,21 @@ class Interpreter(object):
     def prettyPrintObject(self, anObj, doneObjects = None, indent=0):
         doneObjects = doneObjects or []
         ret = ''
+        if isinstance(anObj, SmallInteger):
+            ret += "|  " * indent + "SmallInteger {}".format(anObj.value)
+            if indent == 0:
+                print(ret)
+            return ret
         if anObj in doneObjects:
             ret += "|  " * (indent) + "Object ID {}".format(anObj.objId)
             return ret
         else:
             doneObjects.append(anObj)
         objClass = anObj._class
-        ret += '|  ' * indent + "{} ".format(anObj.objId) + (objClass.pyObjStorage[1].u.pyObjStorage).decode("utf-8")
+        ret += '|  ' * indent + "{} ".format(anObj.objId) + bytes(objClass.pyObjStorage[1].u.pyObjStorage).decode("utf-8")
         if anObj.u.type == QSIL_TYPE_DIRECTOBJECT:
             ret += '\n'
-            ret += "|  " * (indent + 1) + "{}".format(anObj.u.pyObjStorage)
+            ret += "|  " * (indent + 1) + "{}".format(bytes(anObj.u.pyObjStorage))
         elif anObj.u.type == QSIL_TYPE_DIRECTPOINTEROBJECT:
             if anObj.u.pyObjStorage:
                 for obj in anObj.u.pyObjStorage:
@@ -330,18 +1419,16 @@ class Interpreter(object):
             return ret
 
     def qsilNumberPtr(self, num):
+        if SmallInteger.canHold(num):
+            return SmallInteger.forValue(num)
         qsilNumber = Object()
         qsilNumber.interp = self
         qsilNumber.classId = SpecialIDs.INTEGER_CLASS_ID if isinstance(num, int) else SpecialIDs.FLOAT_CLASS_ID
         qsilNumber.type = QSIL_TYPE_DIRECTOBJECT
         numToBytes = struct.pack("<i", num)
         qsilNumber.setMem(numToBytes)
-        qsilNumber.objId = self.nextObjectId()
-        self.objects[qsilNumber.objId] = qsilNumber
-
-        ptr = Pointer.forObject(qsilNumber)
-        ptr.interp = self
-        return ptr
+        self.addObject(qsilNumber)
+        return qsilNumber
 
     def qsilOrderedCollectionPtr(self, objects):
         qsilOrderedCollection = Object()
@@ -349,105 +1436,59 @@ class Interpreter(object):
         qsilOrderedCollection.classId = SpecialIDs.ORDEREDCOLLECTION_CLASS_ID
         qsilOrderedCollection.type = QSIL_TYPE_DIRECTPOINTEROBJECT
         qsilOrderedCollection.setMem(objects)
-        qsilOrderedCollection.objId = self.nextObjectId()
-        self.objects[qsilOrderedCollection.objId] = qsilOrderedCollection
-
-        ptr = Pointer.forObject(qsilOrderedCollection)
-        ptr.interp = self
-        return ptr
+        self.addObject(qsilOrderedCollection)
+        return qsilOrderedCollection
 
     def pushToStack(self, item):
-        contextType = self.activeContext.classId
-        if contextType == SpecialIDs.METHODCONTEXT_CLASS_ID:
-            stack = self.activeContext.u.pyObjStorage[1].u
-            
-            objPtr = Pointer.forObject(item)
-            objPtr.interp = self
-
-            stack.pyObjStorage.append(objPtr)
-            return
-        elif contextType == SpecialIDs.BLOCKCONTEXT_CLASS_ID:
-            #print("Pushing to blockcontext stack!")
-            stack = self.activeContext.u.pyObjStorage[1].u
-
-            objPtr = Pointer.forObject(item)
-            objPtr.interp = self
-
-            stack.pyObjStorage.append(objPtr)
-            return
-        self.prettyPrintObject(self.activeContext)
-        raise RuntimeError("No stack available!")
+        self.activeFrame.stack.append(item)
 
     def popFromStack(self, doPop=True):
-        contextType = self.activeContext.classId
-        if contextType == SpecialIDs.METHODCONTEXT_CLASS_ID:
-            stack = self.activeContext.u.pyObjStorage[1].u
-            if doPop:
-                return stack.pyObjStorage.pop()
-            else:
-                return stack.pyObjStorage[-1]
-        elif contextType == SpecialIDs.BLOCKCONTEXT_CLASS_ID:
-            #print("Popping from blockcontext stack!")
-            stack = self.activeContext.u.pyObjStorage[1].u
-            if doPop:
-                return stack.pyObjStorage.pop()
-            else:
-                return stack.pyObjStorage[-1]
-        self.prettyPrintObject(self.activeContext)
-        raise RuntimeError("No stack available!")
+        if doPop:
+            return self.activeFrame.stack.pop()
+        else:
+            return self.activeFrame.stack[-1]
 
     def getLiteral(self, index):
-        contextType = self.activeContext.classId
-        if contextType == SpecialIDs.METHODCONTEXT_CLASS_ID:
-            #print("Getting literal for MethodContext!")
-            method = self.activeContext.u.pyObjStorage[6].u
-            assert method.classId == SpecialIDs.METHOD_CLASS_ID
-
-            literals = method.pyObjStorage[4].u
-
-            literal = literals.pyObjStorage[index]
-            if literal.u.classId == SpecialIDs.BLOCKCONTEXT_CLASS_ID:
-                # Need to do something here
-                newBlock = self.blockCopy(literal)
-                self.blockBind(newBlock)
-                literal = Pointer.forObject(newBlock)
-                literal.interp = self
-                #print("We've popped a blockcontext")
-            return literal
-        elif contextType == SpecialIDs.BLOCKCONTEXT_CLASS_ID:
-            #print("Getting literal from BlockContext!")
-            literals = self.activeContext.u.pyObjStorage[6].u
-            #self.prettyPrintObject(literals)
-            return literals.pyObjStorage[index]
-        self.prettyPrintObject(self.activeContext)
-        raise RuntimeError("No literal available!")
+        return self.activeFrame.literals[index]
 
     def getArg(self, index):
-        args = self.activeContext.u.pyObjStorage[5].u
-        return args.pyObjStorage[index]
+        return self.activeFrame.args[index]
 
-    def contextForStack(self):
+    def methodCacheKey(self, rcvr, selectorName):
+        # Static sends search the receiving class itself, so they're keyed
+        # by the class object. Everything else is keyed by the receiver's class.
+        if rcvr.classId == SpecialIDs.CLASS_CLASS_ID:
+            return (rcvr.objId, selectorName, True)
+        return (rcvr.classId, selectorName, False)
+
+    def lookupMethod(self, rcvr, selectorName, callSite=None):
+        key = self.methodCacheKey(rcvr, selectorName)
+
+        inlineCache = None
+        if callSite is not None:
+            inlineCache = self.inlineCaches.get(callSite)
+            if inlineCache is None:
+                inlineCache = InlineCache(self.inlineCacheLimit)
+                self.inlineCaches[callSite] = inlineCache
+            foundMethod = inlineCache.lookup(key)
+            if foundMethod is not None:
+                return foundMethod
+
+        foundMethod = self.methodCache.get(key)
+        if foundMethod is not None:
+            self.methodCacheHits += 1
+        else:
+            self.methodCacheMisses += 1
+            foundMethod = self.searchMethod(rcvr, selectorName)
+            if foundMethod is None:
+                return None
+            self.methodCache[key] = foundMethod
 
-        # Get the selector's name and figure out how many arguments
-        # it takes
-        selector = self.popFromStack().u
-        assert selector.classId == SpecialIDs.SYMBOL_CLASS_ID
-        selectorName = selector.pyObjStorage
+        if inlineCache is not None:
+            inlineCache.add(key, foundMethod)
+        return foundMethod
 
-        numArgs = 0
-        if selectorName in specials:
-            numArgs = 1
-        else:
-            numArgs = selectorName.count(b':')
-        
-        # Push the necessary number of arguments onto the stack
-        args = []
-        while len(args) < numArgs:
-            args.insert(0, self.popFromStack())
-        
-        # Get the receiver and search it's class (or superclass)
-        # for the method
-        rcvr = self.popFromStack().u
+    def searchMethod(self, rcvr, selectorName):
         foundMethod = None
         searchedObjectClass = False
         
@@ -455,11 +1496,11 @@ class Interpreter(object):
         # methods, not public/private ones
         searchFlags = []
         
-        currClass = rcvr._class.u
+        currClass = self.objects[rcvr.classId]
         if rcvr.classId == SpecialIDs.CLASS_CLASS_ID:
             searchFlags.append(VisibilityTypes.STATIC)
         else:
-            if rcvr.classId == self.activeContext.u.pyObjStorage[2].u.classId:
+            if rcvr.classId == self.activeFrame.receiver.classId:
                 searchFlags.extend([VisibilityTypes.PROTECTED | VisibilityTypes.PRIVATE])
 
         def matchesSearchFlags(visibility):
@@ -470,11 +1511,10 @@ class Interpreter(object):
 
         while not searchedObjectClass and not foundMethod:
             assert currClass.classId == SpecialIDs.CLASS_CLASS_ID
-            methods = currClass.pyObjStorage[5].u
+            methods = currClass.pyObjStorage[5]
             for method in methods.pyObjStorage:
-                methodName = method.u.pyObjStorage[0].u
-                visibilityPtr = method.u.pyObjStorage[1].u
-                visibility = struct.unpack("<i", visibilityPtr.pyObjStorage)[0]
+                methodName = method.pyObjStorage[0]
+                visibility = integerValue(method.pyObjStorage[1])
                 if methodName.pyObjStorage == selectorName:
                     if matchesSearchFlags(visibility):
                         foundMethod = method
@@ -484,7 +1524,60 @@ class Interpreter(object):
             if currClass.objId == SpecialIDs.CLASS_CLASS_ID:
                 currClass = rcvr
             else:
-                currClass = currClass.pyObjStorage[2].u
+                currClass = currClass.pyObjStorage[2]
+        return foundMethod
+
+    def flushMethodCache(self, selectorName=None):
+        # Needs to be called whenever a class, a method dictionary
+        # or a method changes, or object IDs get renumbered
+        if selectorName is None:
+            self.methodCache.clear()
+            self.inlineCaches.clear()
+            return
+        for key in [key for key in self.methodCache if key[1] == selectorName]:
+            del self.methodCache[key]
+        for inlineCache in self.inlineCaches.values():
+            inlineCache.flush(selectorName)
+
+    def methodCacheStats(self):
+        return {
+            'entries': len(self.methodCache),
+            'hits': self.methodCacheHits,
+            'misses': self.methodCacheMisses,
+        }
+
+    def inlineCacheSites(self, state=None):
+        # Maps (code object id, pc) -> InlineCache for every CALL site that
+        # has run, optionally only the ones in a given state
+        return {site: inlineCache for site, inlineCache in self.inlineCaches.items()
+                if state is None or inlineCache.state == state}
+
+    def contextForStack(self, callSite=None, selector=None):
+        # Get the selector (from the stack, unless SEND_LITERAL already has it)
+        if selector is None:
+            selector = self.popFromStack()
+        assert selector.classId == SpecialIDs.SYMBOL_CLASS_ID
+        return self.contextForSend(selector.pyObjStorage, callSite)
+
+    def contextForSend(self, selectorName, callSite=None, triedPrimitive=None):
+        # Returns the Frame to run for the send, or None if the method's
+        # primitive already replaced the receiver and arguments with its result.
+        # triedPrimitive is one the caller already saw fail on these
+        # operands, so it isn't run again if it's the method's
+
+        # Figure out how many arguments the selector takes
+        numArgs = 0
+        if selectorName in specials:
+            numArgs = 1
+        else:
+            numArgs = selectorName.count(b':')
+        
+        # Get the receiver (under the arguments) and search it's class
+        # (or superclass) for the method
+        stack = self.activeFrame.stack
+        argsStart = len(stack) - numArgs
+        rcvr = stack[argsStart - 1]
+        foundMethod = self.lookupMethod(rcvr, selectorName, callSite)
         
         if foundMethod is None:
             # Call #doesNotUnderstand:
@@ -494,38 +1587,42 @@ class Interpreter(object):
         #self.prettyPrintObject(foundMethod)
         #print("Called method")
 
-        newCtx = Object()
-        newCtx.interp = self
-        newCtx.objId = self.nextObjectId()
-        newCtx.classId = SpecialIDs.METHODCONTEXT_CLASS_ID
-
-        pcPtr = self.qsilNumberPtr(0)
-        stackPtr = self.qsilOrderedCollectionPtr([])
-        receiverPtr = Pointer.forObject(rcvr)
-        receiverPtr.interp = self
-        tempvarsPtr = self.qsilOrderedCollectionPtr([])
-        parentContextPtr = Pointer.forObject(self.activeContext)
-        parentContextPtr.interp = self
-        argsPtr = self.qsilOrderedCollectionPtr(args)
-        argsPtr.interp = self
-
-        newCtx.setMem([pcPtr, stackPtr, receiverPtr, tempvarsPtr, parentContextPtr, argsPtr, foundMethod])
-
-        self.objects[newCtx.objId] = newCtx
-
-        return newCtx
+        # Try the primitive while the receiver and arguments are still on the
+        # stack. The method itself only runs if there isn't one or it fails
+        methodSlots = foundMethod.pyObjStorage
+        if len(methodSlots) > METHOD_PRIMITIVE:
+            primitive = self.primitiveTable.get(integerValue(methodSlots[METHOD_PRIMITIVE]))
+            if primitive is not None and primitive is not triedPrimitive:
+                result = primitive(rcvr, stack[argsStart:])
+                if result is not None:
+                    del stack[argsStart - 1:]
+                    stack.append(result)
+                    return None
+
+        args = stack[argsStart:]
+        del stack[argsStart - 1:]
+
+        # No MethodContext object is made here, see reifyFrame
+        newFrame = Frame()
+        newFrame.receiver = rcvr
+        newFrame.parent = self.activeFrame
+        newFrame.args = args
+        newFrame.method = foundMethod
+        newFrame.literals = foundMethod.pyObjStorage[4].pyObjStorage
+        newFrame.bytecodes = foundMethod.pyObjStorage[3].pyObjStorage
+        newFrame.code = self.decodedCode(newFrame.bytecodes)
+        newFrame.codeId = foundMethod.objId
+
+        return newFrame
 
     def qsilStringPtr(self, string):
         qsilString = Object()
         qsilString.classId = SpecialIDs.BYTESTRING_CLASS_ID
         qsilString.type = QSIL_TYPE_DIRECTOBJECT
         qsilString.setMem(string)
-        qsilString.objId = self.nextObjectId()
-        self.objects[qsilString.objId] = qsilString
-
-        ptr = Pointer.forObject(qsilString)
-        ptr.interp = self
-        return ptr
+        qsilString.interp = self
+        self.addObject(qsilString)
+        return qsilString
 
     def blockCopy(self, blockCtx):
         # May need to redo literal pushing so that
@@ -536,440 +1633,995 @@ class Interpreter(object):
         #self.prettyPrintObject(interp.activeContext)
         #self.prettyPrintObject(blockCtx)
 
-        method = self.activeContext.u.pyObjStorage[6].u
-        assert method.classId == SpecialIDs.METHOD_CLASS_ID
-
+        # The block keeps a reference to its home, so the home
+        # frame needs to exist as a real context from now on.
+        # A block inside another block shares the outer one's home
+        if self.activeFrame.isBlock:
+            homeContext = self.activeFrame.home
+        else:
+            homeContext = self.reifyFrame(self.activeFrame, False)
         
         qsilBlockContext = Object()
         qsilBlockContext.classId = SpecialIDs.BLOCKCONTEXT_CLASS_ID
         qsilBlockContext.interp = self
 
-        pcPtr = self.qsilNumberPtr(0)
-        pcPtr.interp = self
-        stackPtr = self.qsilOrderedCollectionPtr([])
-        stackPtr.interp = self
-        receiverPtr = Pointer.forObject(self.activeContext.u.pyObjStorage[2])
-        receiverPtr.interp = self
-        tempvarsPtr = self.activeContext.u.pyObjStorage[3] # TODO: See if this actually works properly
-        tempvarsPtr.interp = self
-        argsPtr = self.activeContext.u.pyObjStorage[5]
-        argsPtr.interp = self
-        parentContextPtr = Pointer()
-        parentContextPtr.objId = SpecialIDs.NIL_OBJECT_ID
-        parentContextPtr.interp = self
-        bytecodesPtr = blockCtx.u.pyObjStorage[7]
-        literalsPtr = blockCtx.u.pyObjStorage[6]
-        homePtr = Pointer.forObject(self.activeContext)
-        homePtr.interp = self
-
-        bcMem = [pcPtr, stackPtr, receiverPtr, tempvarsPtr, parentContextPtr, argsPtr, literalsPtr, bytecodesPtr, homePtr]
-        qsilBlockContext.setMem(bcMem)
-        qsilBlockContext.objId = self.nextObjectId()
-        self.objects[qsilBlockContext.objId] = qsilBlockContext
+        pc = self.qsilNumberPtr(0)
+        stack = self.qsilOrderedCollectionPtr([])
+        receiver = homeContext.pyObjStorage[2]
+        tempvars = homeContext.pyObjStorage[3] # TODO: See if this actually works properly
+        if self.activeFrame.isBlock:
+            # The outer block's own arguments come after its home's
+            args = self.qsilOrderedCollectionPtr(self.activeFrame.args)
+        else:
+            args = homeContext.pyObjStorage[5]
+        parentContext = self.nilObject
+        blockBytecodes = blockCtx.pyObjStorage[7]
+        literals = blockCtx.pyObjStorage[6]
 
-        ptr = Pointer.forObject(qsilBlockContext)
-        ptr.interp = self
+        bcMem = [pc, stack, receiver, tempvars, parentContext, args, literals, blockBytecodes, homeContext]
+        qsilBlockContext.setMem(bcMem)
+        self.addObject(qsilBlockContext)
 
-        #self.prettyPrintObject(ptr)
+        #self.prettyPrintObject(qsilBlockContext)
 
-        return ptr
+        return qsilBlockContext
     
     def getTemp(self, tempNumber):
-        tempVarsPtr = self.activeContext.u.pyObjStorage[3]
-        if len(tempVarsPtr.u.pyObjStorage) <= tempNumber:
-            nullPtr = Pointer()
-            nullPtr.interp = self
-            nullPtr.objId = SpecialIDs.NIL_OBJECT_ID
-            return nullPtr
-        return tempVarsPtr.u.pyObjStorage[tempNumber]
+        tempVars = self.activeFrame.temps
+        if len(tempVars) <= tempNumber:
+            return self.nilObject
+        return tempVars[tempNumber]
 
     def setTemp(self, tempNumber, tempValue):
-        tempVarsPtr = self.activeContext.u.pyObjStorage[3]
-        if len(tempVarsPtr.u.pyObjStorage) <= tempNumber:
-            diff = (tempNumber - len(tempVarsPtr.u.pyObjStorage)) + 1
-            nullPtr = Pointer()
-            nullPtr.interp = self
-            nullPtr.objId = SpecialIDs.NIL_OBJECT_ID
-            tempVarsPtr.u.pyObjStorage.extend(nullPtr.copy() for _ in range(diff))
-        tempVarsPtr.u.pyObjStorage[tempNumber] = tempValue
+        tempVars = self.activeFrame.temps
+        if len(tempVars) <= tempNumber:
+            diff = (tempNumber - len(tempVars)) + 1
+            tempVars.extend([self.nilObject] * diff)
+        tempVars[tempNumber] = tempValue
+        if self.activeFrame.context is not None:
+            self.writeBarrier(self.activeFrame.context.pyObjStorage[3], tempValue)
 
     def getInstvar(self, varNumber):
-        rcvr = self.activeContext.u.pyObjStorage[2]
-        return rcvr.u.pyObjStorage[varNumber]
+        rcvr = self.activeFrame.receiver
+        return rcvr.pyObjStorage[varNumber]
 
     def setInstvar(self, varNumber, varValue):
-        rcvr = self.activeContext.u.pyObjStorage[2]
-        rcvr.u.pyObjStorage[varNumber] = varValue
+        rcvr = self.activeFrame.receiver
+        rcvr.pyObjStorage[varNumber] = varValue
+        self.writeBarrier(rcvr, varValue)
+        if rcvr.classId in (SpecialIDs.CLASS_CLASS_ID, SpecialIDs.METHOD_CLASS_ID):
+            # Changing a class or method can change what a send finds
+            self.flushMethodCache()
+
+    def writeBarrier(self, anObj, storedObj):
+        # Remember old objects that now refer to young ones, and note the
+        # change for the next delta snapshot
+        if self.snapshotDirty is not None:
+            self.snapshotDirty.add(anObj.objId)
+        if storedObj.__class__ is Object and storedObj.objId in self.nursery and anObj.objId not in self.nursery:
+            self.rememberedSet.add(anObj)
 
     def blockBind(self, blockCtx):
         #self.prettyPrintObject(blockCtx)
         pass
 
+    def buildDispatchTable(self):
+        # One entry per possible bytecode, plus a trailing entry for the
+        # end of a block. The last entry of the decoded code (see
+        # decodeBytecodes) is -1, and table[-1] is that last entry.
+        table = [self.bcUnknown] * 257
+        table[Bytecode.PUSH_SELF] = self.bcPushSelf
+        table[Bytecode.PUSH_SUPER] = self.bcPushSuper
+        table[Bytecode.PUSH_NIL] = self.bcPushNil
+        table[Bytecode.PUSH_TRUE] = self.bcPushTrue
+        table[Bytecode.PUSH_FALSE] = self.bcPushFalse
+        table[Bytecode.PUSH_LITERAL] = self.bcPushLiteral
+        table[Bytecode.PUSH_ARG] = self.bcPushArg
+        table[Bytecode.PUSH_TEMP] = self.bcPushTemp
+        table[Bytecode.PUSH_INSTVAR] = self.bcPushInstvar
+        table[Bytecode.RETURN] = self.bcReturn
+        table[Bytecode.POP] = self.bcPop
+        table[Bytecode.POP_INTO_TEMP] = self.bcPopIntoTemp
+        table[Bytecode.POP_INTO_INSTVAR] = self.bcPopIntoInstvar
+        table[Bytecode.PUSH_OBJ_REF] = self.bcPushObjRef
+        table[Bytecode.CALL] = self.bcCall
+        table[Bytecode.JUMP] = self.bcJump
+        table[Bytecode.JUMP_IF_TRUE] = self.bcJumpIfTrue
+        table[Bytecode.JUMP_IF_FALSE] = self.bcJumpIfFalse
+        table[Bytecode.BECOME_ACTIVECONTEXT] = self.bcBecomeActiveContext
+        table[Bytecode.ALLOC_NEW] = self.bcAllocNew
+        table[Bytecode.ALLOC_NEW_WITHSIZE] = self.bcAllocNewWithSize
+        table[Bytecode.PUSH_THISCONTEXT] = self.bcPushThisContext
+        table[Bytecode.PUSH_CLOSURE] = self.bcPushClosure
+        table[Bytecode.SEND_LITERAL] = self.bcSendLiteral
+        table[Bytecode.RETURN_SELF] = self.bcReturnSelf
+        table[Bytecode.STORE_TEMP_POP] = self.bcStoreTempPop
+        for index in range(len(SPECIAL_SELECTORS)):
+            table[Bytecode.SEND_SPECIAL + index] = self.bcSendSpecial
+        table[Bytecode.PRIM_ADD] = self.bcPrimAdd
+        table[Bytecode.PRIM_COLLECT_GARBAGE] = self.bcPrimCollectGarbage
+        table[Bytecode.PRIM_GC_STATS] = self.bcPrimGcStats
+        table[Bytecode.PRIM_SNAPSHOT] = self.bcPrimSnapshot
+        table[Bytecode.PRIM_SNAPSHOT_CHANGES] = self.bcPrimSnapshotChanges
+        table[0xff] = self.bcPrint
+        table[-1] = self.bcEndOfBlock
+        return table
+
+    def buildPrimitiveTable(self):
+        # Primitive number -> function taking the receiver and a list of the
+        # arguments. Each returns the result, or None if the primitive failed
+        table = {number: self.integerPrimitive(op) for number, op in INTEGER_PRIMITIVES.items()}
+        table[Primitive.AT] = self.primAt
+        table[Primitive.AT_PUT] = self.primAtPut
+        table[Primitive.SIZE] = self.primSize
+        table[Primitive.BASIC_NEW] = self.primBasicNew
+        table[Primitive.BASIC_NEW_WITHSIZE] = self.primBasicNewWithSize
+        table[Primitive.IDENTICAL] = self.primIdentical
+        return table
+
     def interpretOne(self, printBytecode = False):
-        bc = self.peekBc()
+        bc = self.code[self.pc][0]
         if printBytecode:
             print(bc, self.pc)
         # PUSH GLOBAL CONSTANTS
-        #print(self.consolidationCounter)
-        self.consolidationCounter -= 1
-        if self.consolidationCounter == 0:
-            self.garbageCollect()
-
-        if bc == -1:
-            #print("BlockContext ended, returning to parent context")
-            parentContext = self.activeContext.u.pyObjStorage[4]
+        if self.gcPending:
+            self.collect()
+
+        self.dispatchTable[bc]()
+
+    def run(self, maxInstructions=None, until=None):
+        # Run up to maxInstructions bytecodes (or forever), stopping early
+        # once until(self) is true (checked before each bytecode). This does
+        # exactly what calling interpretOne that many times would, but keeps
+        # the running frame's pc, decoded code and stack in locals and handles
+        # the common bytecodes inline. self.pc is only brought up to date
+        # before anything that may look at it: the other bytecodes (which
+        # go through the dispatch table, and may switch frames), collections,
+        # until, and returning. Returns the number of bytecodes run
+        table = self.dispatchTable
+        inlined = RUN_INLINED_BYTECODES
+        limit = -1 if maxInstructions is None else maxInstructions
+        count = 0
+        nilObject = self.nilObject
+        trueObject = self.trueObject
+        qsilNumberPtr = self.qsilNumberPtr
+        specialSends = self.specialSends
+
+        frame = self.activeFrame
+        code = self.code
+        stack = frame.stack
+        pc = self.pc
+        try:
+            while count != limit:
+                if until is not None:
+                    self.pc = pc
+                    if until(self):
+                        break
+                bc, operand, nextPc = code[pc]
+                if self.gcPending:
+                    self.pc = pc
+                    self.collect()
+                count += 1
+
+                if bc not in inlined:
+                    self.pc = pc
+                    # self.pc is the one that counts until it's read back
+                    pc = None
+                    table[bc]()
+                    frame = self.activeFrame
+                    code = self.code
+                    stack = frame.stack
+                    pc = self.pc
+                elif bc == 5: # PUSH_LITERAL
+                    stack.append(frame.literals[operand])
+                    pc = nextPc
+                elif bc == 0: # PUSH_SELF
+                    stack.append(frame.receiver)
+                    pc = nextPc
+                elif bc == 6: # PUSH_ARG
+                    stack.append(frame.args[operand])
+                    pc = nextPc
+                elif bc == 7: # PUSH_TEMP
+                    temps = frame.temps
+                    stack.append(temps[operand] if operand < len(temps) else nilObject)
+                    pc = nextPc
+                elif bc == 8: # PUSH_INSTVAR
+                    stack.append(frame.receiver.pyObjStorage[operand])
+                    pc = nextPc
+                elif bc == 10: # POP
+                    stack.pop()
+                    pc = nextPc
+                elif bc == 16: # JUMP_IF_TRUE
+                    pc = operand if stack.pop() is trueObject else nextPc
+                elif bc == 15: # JUMP
+                    pc = operand
+                elif bc == 25: # JUMP_IF_FALSE
+                    pc = nextPc if stack.pop() is trueObject else operand
+                elif bc == 64: # PRIM_ADD
+                    addTo = stack.pop()
+                    stack.append(qsilNumberPtr(integerValue(frame.receiver) + integerValue(addTo)))
+                    pc = nextPc
+                elif bc == 2: # PUSH_NIL
+                    stack.append(nilObject)
+                    pc = nextPc
+                elif bc == 3: # PUSH_TRUE
+                    stack.append(trueObject)
+                    pc = nextPc
+                elif bc == 4: # PUSH_FALSE
+                    stack.append(self.falseObject)
+                    pc = nextPc
+                elif bc == 11: # POP_INTO_TEMP
+                    self.setTemp(operand, stack[-1])
+                    pc = nextPc
+                elif bc == 12: # POP_INTO_INSTVAR
+                    self.setInstvar(operand, stack[-1])
+                    pc = nextPc
+                elif bc == 24: # STORE_TEMP_POP
+                    self.setTemp(operand, stack.pop())
+                    pc = nextPc
+                else: # SEND_SPECIAL, one of
+                    result = specialSends[bc](stack[-2], stack[-1:])
+                    if result is not None:
+                        del stack[-2:]
+                        stack.append(result)
+                        pc = nextPc
+                    else:
+                        self.pc = pc
+                        pc = None
+                        self.sendSpecialSelector(bc)
+                        frame = self.activeFrame
+                        code = self.code
+                        stack = frame.stack
+                        pc = self.pc
+        finally:
+            if pc is not None:
+                self.pc = pc
+        return count
+
+    def bcEndOfBlock(self):
+        #print("BlockContext ended, returning to parent context")
+        parentFrame = self.parentFrame(self.activeFrame)
+        ret = self.popFromStack()
+        self.setActiveFrame(parentFrame)
+        self.pushToStack(ret)
+
+    def bcPushSelf(self):
+        #print("Push self")
+        self.incrementPc()
+        rcvr = self.activeFrame.receiver
+        self.pushToStack(rcvr)
+
+    def bcPushSuper(self):
+        #print("Push super")
+        # TODO: Continue implementing this
+        self.incrementPc()
+        rcvr = self.activeFrame.receiver
+        foundMethod = self.activeFrame.method
+        methodClass = foundMethod.pyObjStorage[5]
+        superObj = self.objects[QSIL_TYPE_SUPERPOINTER + methodClass.objId]
+        self.pushToStack(superObj)
+
+    def bcPushNil(self):
+        #print("Push nil")
+        self.incrementPc()
+        self.pushToStack(self.nilObject)
+
+    def bcPushTrue(self):
+        #print("Push true")
+        self.incrementPc()
+        self.pushToStack(self.trueObject)
+
+    def bcPushFalse(self):
+        #print("Push false")
+        self.incrementPc()
+        self.pushToStack(self.falseObject)
+
+    # PUSH OTHER
+    # Operands come pre-decoded from self.code, see decodeBytecodes
+    def bcPushLiteral(self):
+        #print("Push literal")
+        _, literalIndex, nextPc = self.code[self.pc]
+        lit = self.getLiteral(literalIndex)
+        #self.prettyPrintObject(lit)
+        self.pushToStack(lit)
+        self.setPc(nextPc)
+
+    def bcPushClosure(self):
+        #print("Push closure")
+        _, literalIndex, nextPc = self.code[self.pc]
+        blockCtx = self.blockCopy(self.getLiteral(literalIndex))
+        self.blockBind(blockCtx)
+        self.pushToStack(blockCtx)
+        self.setPc(nextPc)
+
+    def bcPushArg(self):
+        #print("Push arg")
+        _, argIndex, nextPc = self.code[self.pc]
+        arg = self.getArg(argIndex)
+        #self.prettyPrintObject(arg)
+        self.pushToStack(arg)
+        self.setPc(nextPc)
+
+    def bcPushTemp(self):
+        #print("Push temp")
+        _, tempNumber, nextPc = self.code[self.pc]
+        val = self.getTemp(tempNumber)
+        self.setPc(nextPc)
+        self.pushToStack(val)
+
+    def bcPushInstvar(self):
+        #print("Push instvar")
+        _, varNumber, nextPc = self.code[self.pc]
+        val = self.getInstvar(varNumber)
+        self.setPc(nextPc)
+        self.pushToStack(val)
+
+    def bcReturn(self):
+        #print("Returning!")
+        if self.activeFrame.isBlock:
+            # ^ in a block returns from the method the block is in
+            homeFrame = self.frameForContext(self.activeFrame.home)
             ret = self.popFromStack()
-            self.setActiveContext(parentContext.u)
+            self.setActiveFrame(self.parentFrame(homeFrame))
             self.pushToStack(ret)
             return
-        elif bc == Bytecode.PUSH_SELF:
-            #print("Push self")
-            self.incrementPc()
-            rcvr = self.activeContext.u.pyObjStorage[2]
-            self.pushToStack(rcvr)
-            return
-        elif bc == Bytecode.PUSH_SUPER:
-            #print("Push super")
-            # TODO: Continue implementing this
-            self.incrementPc()
-            rcvr = self.activeContext.u.pyObjStorage[2]
-            foundMethod = self.activeContext.u.pyObjStorage[6]
-            methodClass = foundMethod.u.pyObjStorage[5].u
-            superPtr = Pointer()
-            superPtr.interp = self
-            superPtr.objId = QSIL_TYPE_SUPERPOINTER + methodClass.objId
-            self.pushToStack(superPtr)
-            return
-        elif bc == Bytecode.PUSH_NIL:
-            #print("Push nil")
-            self.incrementPc()
-            truePtr = Pointer()
-            truePtr.interp = self
-            truePtr.objId = SpecialIDs.NIL_OBJECT_ID
-            self.pushToStack(truePtr)
-            return
-        elif bc == Bytecode.PUSH_TRUE:
-            #print("Push true")
-            self.incrementPc()
-            truePtr = Pointer()
-            truePtr.interp = self
-            truePtr.objId = SpecialIDs.TRUE_OBJECT_ID
-            self.pushToStack(truePtr)
-            return
-        elif bc == Bytecode.PUSH_FALSE:
-            #print("Push false")
-            self.incrementPc()
-            truePtr = Pointer()
-            truePtr.interp = self
-            truePtr.objId = SpecialIDs.FALSE_OBJECT_ID
-            self.pushToStack(truePtr)
-            return
-        # PUSH OTHER
-        elif bc == Bytecode.PUSH_LITERAL:
-            #print("Push literal")
-            self.incrementPc()
-            literalIndex = self.peekBc()
-            lit = self.getLiteral(literalIndex)
-            #self.prettyPrintObject(lit)
-            self.pushToStack(lit)
-            self.incrementPc()
-            return
-        elif bc == Bytecode.PUSH_ARG:
-            #print("Push arg")
-            self.incrementPc()
-            argIndex = self.peekBc()
-            arg = self.getArg(argIndex)
-            #self.prettyPrintObject(arg)
-            self.pushToStack(arg)
-            self.incrementPc()
-            return
-        elif bc == Bytecode.PUSH_TEMP:
-            #print("Push temp")
-            self.incrementPc()
-            tempNumber = self.peekBc()
-            val = self.getTemp(tempNumber)
-            self.incrementPc()
-            self.pushToStack(val)
-            return
-        elif bc == Bytecode.PUSH_INSTVAR:
-            #print("Push instvar")
-            self.incrementPc()
-            varNumber = self.peekBc()
-            val = self.getInstvar(varNumber)
-            self.incrementPc()
-            self.pushToStack(val)
-            return
-        elif bc == Bytecode.RETURN:
-            #print("Returning!")
-            if self.activeContext.u.classId == SpecialIDs.BLOCKCONTEXT_CLASS_ID:
-                homeContext = self.activeContext.u.pyObjStorage[8]
-                ret = self.popFromStack()
-                interp.prettyPrintObject(ret)
-                self.setActiveContext(homeContext.u)
-                self.pushToStack(ret)
-                return
-            elif self.activeContext.u.classId == SpecialIDs.METHODCONTEXT_CLASS_ID:
-                parentContext = self.activeContext.u.pyObjStorage[4]
-                ret = self.popFromStack()
-                self.setActiveContext(parentContext.u)
-                self.pushToStack(ret)
-                return
-            self.prettyPrintObject(self.activeContext)
-            raise RuntimeError("1.) Move this to its own method, and 2.) no parent?")
-        # Popping
-        elif bc == Bytecode.POP:
-            #print("Popping from stack")
-            self.popFromStack()
-            self.incrementPc()
-            return
-        elif bc == Bytecode.POP_INTO_TEMP:
-            #print("Pop into temp")
-            valuePtr = self.popFromStack(False)
-            self.incrementPc()
-            tempNumber = self.peekBc()
-            self.setTemp(tempNumber, valuePtr)
-            self.incrementPc()
-            return
-        elif bc == Bytecode.POP_INTO_INSTVAR:
-            #print("Pop into inst var")
-            valuePtr = self.popFromStack(False)
-            self.incrementPc()
-            varNumber = self.peekBc()
-            self.setInstvar(varNumber, valuePtr)
-            self.incrementPc()
-            return
-        # Pushing class references (TODO: Check if this even needed)
-        # Could just push literal since it'd act the same. Everything's
-        # first-class
-        # Could just turn this into the <new> bytecode
-        elif bc == Bytecode.PUSH_OBJ_REF:
-            self.incrementPc()
-            ptr = Pointer()
-            ptr.interp = self
-            objId = 0
-            for i in range(4):
-                objId += self.peekBc() << (i*8)
-                self.incrementPc()
-            ptr.objId = objId
-            self.pushToStack(ptr)
-            return
-        elif bc == Bytecode.CALL:
-            self.incrementPc()
-            newContext = self.contextForStack()
-            self.setActiveContext(newContext)
-            return
-        elif bc == Bytecode.JUMP:
-            #print("Unconditional jump")
-            self.incrementPc()
-            newPc = 0
-            for i in range(4):
-                newPc += self.peekBc() << (i*8)
-                self.incrementPc()
-            self.setPc(newPc)
-            return
-        elif bc == Bytecode.JUMP_IF_TRUE:
-            #print("Conditional jump")
-            self.incrementPc()
-            newPc = 0
-            for i in range(4):
-                newPc += self.peekBc() << (i*8)
-                self.incrementPc()
-            arg = self.popFromStack()
-            if arg.objId == SpecialIDs.TRUE_OBJECT_ID:
-                self.setPc(newPc)
-            return
-        elif bc == Bytecode.BECOME_ACTIVECONTEXT:
-            # TODO: Figure out if nexted blocks, e.g. [[^ self] value] value, would return or not
-            self.incrementPc()
-            rcvr = self.activeContext.u.pyObjStorage[2]
-            self.blockBind(rcvr) # TODO: Implement
-
-            parentContext = Pointer.forObject(self.activeContext)
-            parentContext.interp = self
+        parentFrame = self.parentFrame(self.activeFrame)
+        ret = self.popFromStack()
+        self.setActiveFrame(parentFrame)
+        self.pushToStack(ret)
+
+    # Popping
+    def bcPop(self):
+        #print("Popping from stack")
+        self.popFromStack()
+        self.incrementPc()
 
-            rcvr.u.pyObjStorage[4] = parentContext
-            self.setActiveContext(rcvr.u)
-            self.setPc(0) # Jump to the beginning
-            #print("Changed to a blockContext!")
+    def bcPopIntoTemp(self):
+        #print("Pop into temp")
+        valuePtr = self.popFromStack(False)
+        _, tempNumber, nextPc = self.code[self.pc]
+        self.setTemp(tempNumber, valuePtr)
+        self.setPc(nextPc)
+
+    def bcPopIntoInstvar(self):
+        #print("Pop into inst var")
+        valuePtr = self.popFromStack(False)
+        _, varNumber, nextPc = self.code[self.pc]
+        self.setInstvar(varNumber, valuePtr)
+        self.setPc(nextPc)
+
+    # Pushing class references (TODO: Check if this even needed)
+    # Could just push literal since it'd act the same. Everything's
+    # first-class
+    # Could just turn this into the <new> bytecode
+    def bcPushObjRef(self):
+        _, objId, nextPc = self.code[self.pc]
+        self.setPc(nextPc)
+        if objId.__class__ is SmallInteger:
+            self.pushToStack(objId)
             return
-        elif bc == Bytecode.ALLOC_NEW:
-            #print("Make a new object!")
-            rcvr = self.activeContext.u.pyObjStorage[2].u
-            assert rcvr.classId == SpecialIDs.CLASS_CLASS_ID
-
-            newObj = Object()
-            newObj.interp = self
-            newObj.classId = rcvr.objId
-
-            nullPtr = Pointer()
-            nullPtr.interp = self
-            nullPtr.objId = SpecialIDs.NIL_OBJECT_ID
-
-            objType = rcvr.pyObjStorage[0].u.pyObjStorage
-            if objType == b'subclass:':
-                newObj.type = QSIL_TYPE_POINTEROBJECT
-            else:
-                raise RuntimeError("Unknown object type: {}".format(objType))
+        self.pushToStack(self.objects[objId])
 
-            numInstVars = len(rcvr.pyObjStorage[3].u.pyObjStorage)
-
-            newObj.setMem([nullPtr.copy() for _ in range(numInstVars)])
-
-            newObj.objId = self.nextObjectId()
-            self.objects[newObj.objId] = newObj
-
-            retPtr = Pointer.forObject(newObj)
-            retPtr.interp = self
-
-            self.pushToStack(retPtr)
+    def bcCall(self):
+        callSite = (self.codeId, self.pc)
+        self.incrementPc()
+        newFrame = self.contextForStack(callSite)
+        if newFrame is not None:
+            self.setActiveFrame(newFrame)
+
+    def bcSendSpecial(self):
+        # Integers (and ==) are dealt with here, without looking anything up
+        bc = self.code[self.pc][0]
+        stack = self.activeFrame.stack
+        result = self.specialSends[bc](stack[-2], stack[-1:])
+        if result is None:
+            self.sendSpecialSelector(bc)
+        else:
+            del stack[-2:]
+            stack.append(result)
             self.incrementPc()
-            return
-        elif bc == Bytecode.ALLOC_NEW_WITHSIZE:
-            #print("Make a new object with size!")
-            rcvr = self.activeContext.u.pyObjStorage[2].u
-            assert rcvr.classId == SpecialIDs.CLASS_CLASS_ID
-
-            newObj = Object()
-            newObj.interp = self
-            newObj.classId = rcvr.objId
-
-            nullPtr = Pointer()
-            nullPtr.interp = self
-            nullPtr.objId = SpecialIDs.NIL_OBJECT_ID
-
-            objType = rcvr.pyObjStorage[0].u.pyObjStorage
-            if objType == b'subclass:':
-                newObj.type = QSIL_TYPE_POINTEROBJECT
-            else:
-                raise RuntimeError("Unknown object type: {}".format(objType))
 
-            sizePtr = self.getArg(0)
-            numInstVars = struct.unpack('<i', sizePtr.u.pyObjStorage)[0]
-
-            newObj.setMem([nullPtr.copy() for _ in range(numInstVars)])
-
-            newObj.objId = self.nextObjectId()
-            self.objects[newObj.objId] = newObj
+    def sendSpecialSelector(self, bc):
+        callSite = (self.codeId, self.pc)
+        self.incrementPc()
+        # Only called once the special send's primitive has failed
+        newFrame = self.contextForSend(SPECIAL_SELECTORS[bc - Bytecode.SEND_SPECIAL][0], callSite,
+                                       self.specialSends[bc])
+        if newFrame is not None:
+            self.setActiveFrame(newFrame)
+
+    def bcJump(self):
+        #print("Unconditional jump")
+        self.setPc(self.code[self.pc][1])
+
+    def bcJumpIfTrue(self):
+        #print("Conditional jump")
+        _, newPc, nextPc = self.code[self.pc]
+        self.setPc(nextPc)
+        arg = self.popFromStack()
+        if arg is self.trueObject:
+            self.setPc(newPc)
 
-            retPtr = Pointer.forObject(newObj)
-            retPtr.interp = self
+    def bcJumpIfFalse(self):
+        # Jumps unless the value is true, so it never jumps when
+        # JUMP_IF_TRUE would
+        _, newPc, nextPc = self.code[self.pc]
+        self.setPc(nextPc)
+        arg = self.popFromStack()
+        if arg is not self.trueObject:
+            self.setPc(newPc)
 
-            self.pushToStack(retPtr)
-            self.incrementPc()
-            return
-        elif bc == Bytecode.PRIM_ADD:
-            # TODO: Probably should cache numbers from -127 to 127
-            rcvr = self.activeContext.u.pyObjStorage[2]
-            addTo = self.popFromStack()
-            res = 0
-            res += struct.unpack("<i", rcvr.u.pyObjStorage)[0]
-            res += struct.unpack("<i", addTo.u.pyObjStorage)[0]
-            self.pushToStack(self.qsilNumberPtr(res))
-            self.incrementPc()
-            return
-        elif bc == 0xff:
-            #print("TEMPORARY BYTECODE FOR PRINTING: MOVE TO PRIMS")
-            self.incrementPc()
-            item = self.getArg(0).u
-            #print(item.objId)
-            #print(struct.unpack("<i",item.pyObjStorage)[0])
-            self.prettyPrintObject(item)
-            return
-        print(hex(bc))
+    def bcBecomeActiveContext(self):
+        # TODO: Figure out if nexted blocks, e.g. [[^ self] value] value, would return or not
+        self.incrementPc()
+        rcvr = self.activeFrame.receiver
+        self.blockBind(rcvr) # TODO: Implement
+
+        # Every activation of the block gets a fresh frame, the
+        # BlockContext's parentContext is only filled in by reifyFrame
+        blockFrame = self.frameForBlock(rcvr)
+        blockFrame.parent = self.activeFrame
+        # The arguments of value: and friends follow the ones the block
+        # can see from around it, as the compiler numbers them
+        blockFrame.args = blockFrame.args + self.activeFrame.args
+        if blockFrame.home is self.nilObject:
+            # A clean block is pushed as the literal itself (see PUSH_CLOSURE),
+            # so every activation gets its own stack and temps, and its own
+            # context if reifyFrame is asked for one
+            blockFrame.stack = []
+            blockFrame.temps = []
+            blockFrame.context = None
+        else:
+            rcvr.frame = blockFrame
+        self.setActiveFrame(blockFrame)
+        self.setPc(0) # Jump to the beginning
+        #print("Changed to a blockContext!")
+
+    # Superinstructions, each doing what its pair in SUPERINSTRUCTIONS would
+    def bcSendLiteral(self):
+        # The selector goes straight to the send instead of via the stack
+        _, literalIndex, nextPc = self.code[self.pc]
+        callSite = (self.codeId, self.pc)
+        selector = self.getLiteral(literalIndex)
+        self.setPc(nextPc)
+        newFrame = self.contextForStack(callSite, selector)
+        if newFrame is not None:
+            self.setActiveFrame(newFrame)
+
+    def bcReturnSelf(self):
+        self.pushToStack(self.activeFrame.receiver)
+        self.bcReturn()
+
+    def bcStoreTempPop(self):
+        _, tempNumber, nextPc = self.code[self.pc]
+        self.setTemp(tempNumber, self.popFromStack())
+        self.setPc(nextPc)
+
+    def bcAllocNew(self):
+        #print("Make a new object!")
+        rcvr = self.activeFrame.receiver
+        assert rcvr.classId == SpecialIDs.CLASS_CLASS_ID
+
+        newObj = self.instantiate(rcvr)
+        if newObj is None:
+            raise RuntimeError("Unknown object type: {}".format(rcvr.pyObjStorage[0].pyObjStorage))
+
+        self.pushToStack(newObj)
         self.incrementPc()
-        #self.prettyPrintObject(self.activeContext)
 
-    def garbageCollect(self):
-        # Garbage collect and consolidate object IDs
-        if False:
-            # Garbage collection is broken, may need to redo the algorithm and make it work properly
-            # Save all pointers and objects to a list, and just set their objIds?
-            return
-        self.consolidationCounter = 10000
+    def bcAllocNewWithSize(self):
+        #print("Make a new object with size!")
+        rcvr = self.activeFrame.receiver
+        assert rcvr.classId == SpecialIDs.CLASS_CLASS_ID
 
-        classIds = []
-        self.idsReferencedBy(self.objects[SpecialIDs.QSIL_IMAGE_ID], classIds)
-        self.idsReferencedBy(self.activeContext, classIds)
+        newObj = Object()
+        newObj.interp = self
+        newObj.classId = rcvr.objId
 
-        for specialId in range(SpecialIDs.numObjs):
-            if specialId not in classIds:
-                classIds.append(specialId)
+        objType = rcvr.pyObjStorage[0].pyObjStorage
+        if objType == b'subclass:':
+            newObj.type = QSIL_TYPE_POINTEROBJECT
+        else:
+            raise RuntimeError("Unknown object type: {}".format(objType))
 
-        classIds = list(sorted(classIds))
+        numInstVars = integerValue(self.getArg(0))
 
-        # print(classIds)
+        newObj.setMem([self.nilObject] * numInstVars)
 
-        hashMap = {}
-        for id in range(len(classIds)):
-            if id in classIds:
-                hashMap[id] = id
-                del classIds[classIds.index(id)]
-            else:
-                hashMap[classIds[-1]] = id
-                del classIds[-1]
+        self.addObject(newObj)
 
-        doneObjects = []
+        self.pushToStack(newObj)
+        self.incrementPc()
 
-        #print(hashMap)
-        #print(self.objects[7208], hashMap[7208])
+    def instantiate(self, aClass, size=0):
+        # A new instance of aClass with its instance variables set to nil,
+        # plus size indexed slots (or bytes) if it's a variable class.
+        # None for kinds of class this can't make
+        newObj = Object()
+        newObj.interp = self
+        newObj.classId = aClass.objId
+
+        objType = aClass.pyObjStorage[0].pyObjStorage
+        numInstVars = len(aClass.pyObjStorage[3].pyObjStorage)
+        if objType == b'subclass:':
+            newObj.type = QSIL_TYPE_POINTEROBJECT
+            newObj.setMem([self.nilObject] * numInstVars)
+        elif objType == b'variablePointerSubclass:':
+            newObj.type = QSIL_TYPE_DIRECTPOINTEROBJECT
+            newObj.setMem([self.nilObject] * (numInstVars + size))
+        elif objType == b'variableByteSubclass:':
+            newObj.type = QSIL_TYPE_DIRECTOBJECT
+            newObj.setMem(bytearray(size))
+        else:
+            return None
 
-        self.remapObjects(self.objects[SpecialIDs.QSIL_IMAGE_ID], doneObjects, hashMap)
-        self.remapObjects(self.activeContext, doneObjects, hashMap)
-        #self.prettyPrintObject(self.activeContext)
+        self.addObject(newObj)
+        return newObj
 
-        for anObj in doneObjects:
-            anObj.objId = hashMap[anObj.objId]
-            if anObj.type == QSIL_TYPE_DIRECTPOINTEROBJECT:
-                self.objects[anObj.objId] = anObj
-            elif anObj.type == QSIL_TYPE_POINTEROBJECT:
-                self.objects[anObj.objId] = anObj
-            elif anObj.type == QSIL_TYPE_DIRECTOBJECT:
-                self.objects[anObj.objId] = anObj
+    def bcPushThisContext(self):
+        self.incrementPc()
+        self.pushToStack(self.reifyFrame(self.activeFrame))
 
-        #print(hashMap)
+    def bcPrimAdd(self):
+        rcvr = self.activeFrame.receiver
+        addTo = self.popFromStack()
+        res = integerValue(rcvr) + integerValue(addTo)
+        self.pushToStack(self.qsilNumberPtr(res))
+        self.incrementPc()
 
-        newObjs = {}
-        for id in hashMap.values():
-            newObjs[id] = self.objects[id]
-        self.objects = newObjs
+    def bcPrimCollectGarbage(self):
+        self.incrementPc()
+        freed = self.collect(True)
+        self.pushToStack(self.qsilNumberPtr(freed))
 
-        self.highestId = len(hashMap) - 1
+    def bcPrimGcStats(self):
+        # Same counters as gcStats(), as an OrderedCollection of Integers
+        self.incrementPc()
+        gcStats = self.gcStats()
+        counters = [gcStats['full cycles'], gcStats['minor cycles'], gcStats['live before'], gcStats['live after'],
+                    gcStats['total freed'], gcStats['total bytes freed'], int(gcStats['total pause'] * 1000000)]
+        counters.extend(self.gcPauseHistogram)
+        self.pushToStack(self.qsilOrderedCollectionPtr([self.qsilNumberPtr(counter) for counter in counters]))
+
+    def bcPrimSnapshot(self, delta=False):
+        # Like Smalltalk's snapshot primitive, the saved image resumes with
+        # true on the stack while the running one carries on with false
+        self.incrementPc()
+        fileName = bytes(self.popFromStack().pyObjStorage).decode()
+        self.pushToStack(self.trueObject)
+        self.snapshot(fileName, delta)
+        self.popFromStack()
+        self.pushToStack(self.falseObject)
 
+    def bcPrimSnapshotChanges(self):
+        self.bcPrimSnapshot(True)
 
-    def remapObjects(self, anObj, doneObjects, hashMap):
-        if anObj in doneObjects:
-            return
-        else:
-            doneObjects.append(anObj)
+    def bcPrint(self):
+        #print("TEMPORARY BYTECODE FOR PRINTING: MOVE TO PRIMS")
+        self.incrementPc()
+        item = self.getArg(0)
+        #print(item.objId)
+        #print(struct.unpack("<i",item.pyObjStorage)[0])
+        self.prettyPrintObject(item)
 
-        self.remapObjects(anObj.u, doneObjects, hashMap)
+    def bcUnknown(self):
+        print(hex(self.peekBc()))
+        self.incrementPc()
+        #self.prettyPrintObject(self.activeContext)
 
-        if anObj.type == QSIL_TYPE_POINTER:
-            pass
-        elif anObj.type == QSIL_TYPE_DIRECTOBJECT:
-            pass
+    # Primitives, see buildPrimitiveTable
+    def integerPrimitive(self, op):
+        def primitive(rcvr, args):
+            arg = args[0]
+            if rcvr.classId != SpecialIDs.INTEGER_CLASS_ID or arg.classId != SpecialIDs.INTEGER_CLASS_ID:
+                return None
+            try:
+                res = op(integerValue(rcvr), integerValue(arg))
+            except ZeroDivisionError:
+                return None
+            if res is None:
+                return None
+            if res is True:
+                return self.trueObject
+            if res is False:
+                return self.falseObject
+            if not -0x80000000 <= res <= 0x7fffffff:
+                return None # Doesn't fit in a boxed Integer either
+            return self.qsilNumberPtr(res)
+        return primitive
+
+    def indexableSlots(self, anObj):
+        # What at:, at:put: and size index into, and how many slots come
+        # before the first indexed one (a variable pointer object's named
+        # instance variables, see instantiate). None if anObj only has
+        # named instance variables
+        if anObj.type == QSIL_TYPE_DIRECTPOINTEROBJECT:
+            return anObj.pyObjStorage, len(self.objects[anObj.classId].pyObjStorage[3].pyObjStorage)
+        if anObj.type == QSIL_TYPE_DIRECTOBJECT and anObj.classId not in (SpecialIDs.INTEGER_CLASS_ID, SpecialIDs.FLOAT_CLASS_ID):
+            return anObj.pyObjStorage, 0
+        return None, 0
+
+    def primAt(self, rcvr, args):
+        index = args[0]
+        slots, firstSlot = self.indexableSlots(rcvr)
+        if slots is None or index.classId != SpecialIDs.INTEGER_CLASS_ID:
+            return None
+        index = integerValue(index)
+        if not 1 <= index <= len(slots) - firstSlot:
+            return None
+        item = slots[firstSlot + index - 1]
+        if rcvr.type == QSIL_TYPE_DIRECTOBJECT:
+            return self.qsilNumberPtr(item)
+        return item
+
+    def primAtPut(self, rcvr, args):
+        index, value = args
+        slots, firstSlot = self.indexableSlots(rcvr)
+        # Symbols are selectors, which have to stay unchanged (and hashable)
+        if (slots is None or rcvr.classId == SpecialIDs.SYMBOL_CLASS_ID or
+                index.classId != SpecialIDs.INTEGER_CLASS_ID):
+            return None
+        index = integerValue(index)
+        if not 1 <= index <= len(slots) - firstSlot:
+            return None
+        if rcvr.type == QSIL_TYPE_DIRECTOBJECT:
+            if value.classId != SpecialIDs.INTEGER_CLASS_ID or not 0 <= integerValue(value) <= 255:
+                return None
+            rcvr.writableStorage()[index - 1] = integerValue(value)
         else:
-            self.remapObjects(anObj._class, doneObjects, hashMap)
-            for obj in anObj.pyObjStorage:
-                self.remapObjects(obj, doneObjects, hashMap)
+            oldValue = slots[firstSlot + index - 1]
+            slots[firstSlot + index - 1] = value
+            if SpecialIDs.METHOD_CLASS_ID in (oldValue.classId, value.classId):
+                # Putting a method into (or taking one out of) a class's
+                # methods changes what a send finds. Methods themselves
+                # have no indexed slots, so can't get here
+                self.flushMethodCache()
+        self.writeBarrier(rcvr, value)
+        return value
+
+    def primSize(self, rcvr, args):
+        slots, firstSlot = self.indexableSlots(rcvr)
+        return self.qsilNumberPtr(0 if slots is None else len(slots) - firstSlot)
+
+    def primBasicNew(self, rcvr, args):
+        if rcvr.classId != SpecialIDs.CLASS_CLASS_ID:
+            return None
+        return self.instantiate(rcvr)
+
+    def primBasicNewWithSize(self, rcvr, args):
+        size = args[0]
+        if (rcvr.classId != SpecialIDs.CLASS_CLASS_ID or size.classId != SpecialIDs.INTEGER_CLASS_ID or
+                integerValue(size) < 0 or rcvr.pyObjStorage[0].pyObjStorage == b'subclass:'):
+            return None
+        return self.instantiate(rcvr, integerValue(size))
+
+    def primIdentical(self, rcvr, args):
+        return self.trueObject if rcvr.objId == args[0].objId else self.falseObject
+
+    def collect(self, full=False):
+        # Run a collection now. Without full, this scavenges the nursery
+        # unless the heap has outgrown fullGcThreshold
+        if full or self.objects.liveCount() > self.fullGcThreshold:
+            return self.garbageCollect()
+        return self.scavenge()
 
-    def idsReferencedBy(self, anObj, doneObjects):
-        if anObj.objId in doneObjects:
-            return
+    def garbageCollect(self):
+        # Mark everything reachable from the roots, then free the ids of
+        # everything else so they can be reused. Live objects keep their ids
+        startTime = time.perf_counter()
+        liveBefore = self.objects.liveCount()
+
+        marked = self.markReachable(self.gcRoots())
+        freed, bytesFreed = self.sweep(marked)
+
+        # Everything left is old now
+        self.resetNursery()
+        self.fullGcThreshold = max(self.fullGcMinimum, int(self.objects.liveCount() * self.gcGrowthFactor))
+
+        # Freed class ids may be handed out again. Running frames keep
+        # their decoded code, the cache is just refilled as methods are
+        # called, without whatever bytecodes have died since
+        self.flushMethodCache()
+        self.codeCache.clear()
+
+        self.recordGcCycle('full', time.perf_counter() - startTime, freed, bytesFreed, liveBefore)
+        return freed
+
+    def compact(self):
+        # Collections never move objects, so ids stay stable. This packs the
+        # live objects into the lowest ids when asked to (e.g. before writing
+        # an image). Classes stay put: classId fields and PUSH_OBJ_REF
+        # operands refer to them by id
+        self.materializeAll()
+        self.garbageCollect()
+        moved = self.objects.compact(
+            lambda obj: obj is not None and obj.classId != SpecialIDs.CLASS_CLASS_ID)
+        if moved:
+            self.inlineCaches = {(moved.get(codeId, codeId), pc): inlineCache
+                                 for (codeId, pc), inlineCache in self.inlineCaches.items()}
+            self.refreshCodeIds()
+            self.flushMethodCache()
+            # Ids in an earlier snapshot no longer line up with the table
+            self.snapshotFile = None
+        return moved
+
+    def snapshot(self, fileName, delta=False, compact=False, version=imageFormat, compress=False):
+        # Write the heap, including the running contexts, as an image that
+        # readFile resumes from exactly where execution stopped. With delta,
+        # only what was made, changed or freed since the last snapshot to
+        # the same file is appended to it (a full snapshot is written if
+        # there wasn't one). Only format 1 images can be appended to
+        startTime = time.perf_counter()
+        delta = delta and version == 1 and fileName == self.snapshotFile and self.snapshotDirty is not None
+        if compact and not delta:
+            self.compact()
+        if version == 2:
+            self.materializeAll()
+        elif version != 1:
+            raise RuntimeError("Unsupported image format {}".format(version))
+        contextObjId = self.reifyFrameChain().objId
+        liveIds = self.snapshotLiveIds()
+
+        if delta:
+            previousIds = self.snapshotIds
+            objIds = sorted(objId for objId in self.snapshotDirty if objId < len(liveIds) and liveIds[objId])
+            freedIds = [objId for objId in range(len(previousIds))
+                        if previousIds[objId] and not (objId < len(liveIds) and liveIds[objId])]
+            with open(fileName, "ab") as outFile:
+                startOffset = outFile.tell()
+                outFile.write(struct.pack("<i", len(objIds)))
+                for objId in objIds:
+                    self.writeSnapshotObject(outFile, objId)
+                outFile.write(struct.pack(f"<{len(freedIds) + 1}i", len(freedIds), *freedIds))
+                outFile.write(struct.pack("<i", contextObjId))
+                numBytes = outFile.tell() - startOffset
         else:
-            doneObjects.append(anObj.objId)
-
-        self.idsReferencedBy(anObj._class, doneObjects)
-
-        actualObj = anObj.u
-        if actualObj.type == QSIL_TYPE_DIRECTOBJECT:
-            return
-        elif actualObj.type == QSIL_TYPE_DIRECTPOINTEROBJECT:
-            for obj in actualObj.pyObjStorage:
-                self.idsReferencedBy(obj, doneObjects)
+            objIds = [objId for objId, live in enumerate(liveIds) if live]
+            # Written alongside and then moved over, as the file being
+            # replaced may be the image this interpreter has mapped
+            tempName = fileName + ".tmp"
+            with open(tempName, "wb") as outFile:
+                if version == 2:
+                    writeImageV2(outFile, [self.objects[objId] for objId in objIds], contextObjId, compress)
+                else:
+                    outFile.write(struct.pack("<i", len(objIds)))
+                    for objId in objIds:
+                        self.writeSnapshotObject(outFile, objId)
+                    outFile.write(struct.pack("<i", contextObjId))
+                numBytes = outFile.tell()
+            os.replace(tempName, fileName)
+            # Format 2 can't be appended to, so there's nothing to track
+            if version != 1:
+                fileName = None
+
+        self.snapshotFile = fileName
+        self.snapshotDirty = set()
+        self.snapshotIds = liveIds
+        self.snapshotStats = {
+            'objects': len(objIds),
+            'bytes': numBytes,
+            'seconds': time.perf_counter() - startTime,
+            'delta': delta,
+        }
+        return self.snapshotStats
+
+    def reifyFrameChain(self):
+        # Bring the context of every frame on the chain up to date, so the
+        # pcs, stacks and parent links written out are the current ones.
+        # Returns the active context
+        activeContext = self.reifyFrame(self.activeFrame)
+        for frame in list(self.frameChain()):
+            ctx = self.reifyFrame(frame, False)
+            if self.snapshotDirty is not None:
+                self.snapshotDirty.add(ctx.objId)
+                self.snapshotDirty.update(ctx.pyObjStorage[slot].objId for slot in (1, 3, 5))
+        return activeContext
+
+    def snapshotLiveIds(self):
+        # Marks, by id, everything a snapshot writes: the objects in the
+        # table and whatever a lazily read image hasn't read in yet
+        liveIds = bytearray(len(self.objects))
+        # Iterating the table directly doesn't make shells
+        for objId, obj in enumerate(self.objects):
+            if obj is not None:
+                liveIds[objId] = 1
+        if self.lazyOffsets is not None:
+            for objId, offset in enumerate(self.lazyOffsets):
+                if offset >= 0:
+                    liveIds[objId] = 1
+        return liveIds
+
+    def writeSnapshotObject(self, stream, objId):
+        lazyOffsets = self.lazyOffsets
+        if lazyOffsets is not None and objId < len(lazyOffsets) and lazyOffsets[objId] >= 0:
+            # Not read in yet, so it's unchanged: copy it from the image as is
+            offset = lazyOffsets[objId]
+            objType, _, _, size = OBJECT_HEADER.unpack_from(self.image, offset)
+            end = offset + OBJECT_HEADER.size + (size if objType == QSIL_TYPE_DIRECTOBJECT else 4 * size)
+            stream.write(self.imageView[offset:end])
         else:
-            for obj in actualObj.pyObjStorage:
-                self.idsReferencedBy(obj, doneObjects)
+            self.objects[objId].writeTo(stream)
+
+    def scavenge(self):
+        # Collect the young generation only. Everything reachable from the
+        # running frames or the remembered set survives and is promoted, the
+        # rest of the nursery is freed. Old objects aren't traced at all
+        startTime = time.perf_counter()
+        liveBefore = self.objects.liveCount()
+
+        objects = self.objects
+        nursery = self.nursery
+        survivors = set()
+        worklist = self.frameRoots()
+        for rememberedObj in self.rememberedSet:
+            if rememberedObj.type != QSIL_TYPE_DIRECTOBJECT:
+                worklist.extend(rememberedObj.pyObjStorage)
+        while worklist:
+            obj = worklist.pop()
+            if obj.__class__ is not Object:
+                continue
+            objId = obj.objId
+            if objId not in nursery or objId in survivors:
+                continue
+            survivors.add(objId)
+            # A class made since the last scavenge may only be reachable
+            # through its instances
+            worklist.append(objects[obj.classId])
+            if obj.type != QSIL_TYPE_DIRECTOBJECT:
+                worklist.extend(obj.pyObjStorage)
+
+        deadIds = nursery - survivors
+        bytesFreed = 0
+        freedClassOrMethod = False
+        for objId in deadIds:
+            obj = objects[objId]
+            if obj is not None:
+                bytesFreed += imageSize(obj)
+                if obj.classId in (SpecialIDs.CLASS_CLASS_ID, SpecialIDs.METHOD_CLASS_ID):
+                    freedClassOrMethod = True
+                objects[objId] = None
+        objects.freeIds.extend(deadIds)
+        freed = len(deadIds)
+
+        self.resetNursery()
+        # The caches only go stale if the id of a class or method they hold
+        # can be handed out again. Most scavenges free neither, so only the
+        # inline caches of code that died are dropped
+        if freedClassOrMethod:
+            self.flushMethodCache()
+        elif freed:
+            for callSite in [callSite for callSite in self.inlineCaches if callSite[0] in deadIds]:
+                del self.inlineCaches[callSite]
+
+        self.recordGcCycle('minor', time.perf_counter() - startTime, freed, bytesFreed, liveBefore)
+        return freed
+
+    def resetNursery(self):
+        self.nursery.clear()
+        self.nurseryBytes = 0
+        self.rememberedSet.clear()
+        self.gcPending = False
+
+    def markReachable(self, roots):
+        # Iterative marking with an explicit worklist, one mark byte per id,
+        # so deep object graphs can't hit the recursion limit
+        objects = self.objects
+        lazyOffsets = self.lazyOffsets
+        marked = bytearray(len(objects))
+        worklist = list(roots)
+        while worklist:
+            obj = worklist.pop()
+            if obj is None or obj.__class__ is SmallInteger:
+                continue
+            objId = obj.objId
+            if obj.__class__ is Pointer:
+                # Left over from the image, marks whatever it points to
+                worklist.append(objects.get(objId))
+                continue
+            if marked[objId]:
+                continue
+            marked[objId] = 1
+            if lazyOffsets is not None and objId < len(lazyOffsets) and lazyOffsets[objId] >= 0:
+                # Not read in yet, so it can't refer to anything new
+                continue
+            worklist.append(objects[obj.classId])
+            if obj.type != QSIL_TYPE_DIRECTOBJECT:
+                worklist.extend(obj.pyObjStorage)
+        return marked
+
+    def sweep(self, marked):
+        objects = self.objects
+        freeIds = set(objects.freeIds)
+        if self.lazyOffsets is not None:
+            # Image objects nothing has looked up yet have nothing to free
+            freeIds.update(objId for objId, offset in enumerate(self.lazyOffsets) if offset >= 0)
+        freed = 0
+        bytesFreed = 0
+        for objId in range(SpecialIDs.numObjs, len(objects)):
+            if not marked[objId] and objId not in freeIds:
+                if objects[objId] is not None:
+                    bytesFreed += imageSize(objects[objId])
+                objects.free(objId)
+                freed += 1
+        objects.shrink()
+        return freed, bytesFreed
+
+    def recordGcCycle(self, kind, pauseTime, freed, bytesFreed, liveBefore):
+        self.gcCycles[kind] += 1
+        self.gcTotalPause += pauseTime
+        self.gcTotalFreed += freed
+        self.gcTotalBytesFreed += bytesFreed
+        bucket = 0
+        while bucket < len(self.gcPauseBuckets) and pauseTime >= self.gcPauseBuckets[bucket]:
+            bucket += 1
+        self.gcPauseHistogram[bucket] += 1
+        self.gcHistory.append({
+            'kind': kind,
+            'pause': pauseTime,
+            'freed': freed,
+            'bytes freed': bytesFreed,
+            'live before': liveBefore,
+            'live after': self.objects.liveCount(),
+        })
+        del self.gcHistory[:-self.gcHistoryLength]
+
+    def gcStats(self):
+        # Collection counts, pause times (seconds), objects and bytes freed,
+        # and the live object counts around the last cycle
+        lastCycle = self.gcHistory[-1] if self.gcHistory else {}
+        return {
+            'full cycles': self.gcCycles['full'],
+            'minor cycles': self.gcCycles['minor'],
+            'total pause': self.gcTotalPause,
+            'pause histogram': list(zip(self.gcPauseBuckets + [None], self.gcPauseHistogram)),
+            'total freed': self.gcTotalFreed,
+            'total bytes freed': self.gcTotalBytesFreed,
+            'live before': lastCycle.get('live before', 0),
+            'live after': lastCycle.get('live after', self.objects.liveCount()),
+            'nursery': len(self.nursery),
+            'remembered': len(self.rememberedSet),
+            'recent': list(self.gcHistory),
+        }
+
+    def gcRoots(self):
+        # The image and the special objects, plus everything the running
+        # frames hold on to. Objects from a lazily read image are all kept
+        # (see sweep), since what they refer to isn't known until they're
+        # read in
+        return [self.objects.get(objId) for objId in range(SpecialIDs.numObjs)] + self.imageObjects() + self.frameRoots()
+
+    def frameRoots(self):
+        roots = []
+        for frame in self.frameChain():
+            roots.append(frame.receiver)
+            roots.extend(frame.stack)
+            roots.extend(frame.temps)
+            roots.extend(frame.args)
+            for ptr in (frame.method, frame.home, frame.context, frame.block):
+                if ptr is not None:
+                    roots.append(ptr)
+        return roots
+
+    def refreshCodeIds(self):
+        for frame in self.frameChain():
+            if frame.isBlock:
+                frame.codeId = frame.block.pyObjStorage[7].objId
+            else:
+                frame.codeId = frame.method.objId
+        self.codeId = self.activeFrame.codeId
+
+    def frameChain(self):
+        # The active frame and its callers, including frames that are only
+        # reachable through a reified context's parentContext
+        frame = self.activeFrame
+        while frame is not None:
+            yield frame
+            if frame.parent is not None:
+                frame = frame.parent
+            elif frame.context is not None:
+                frame = getattr(frame.context.pyObjStorage[4], 'frame', None)
+            else:
+                frame = None
 
 
 if __name__ == '__main__':
@@ -979,19 +2631,18 @@ if __name__ == '__main__':
     interp = Interpreter()
     interp.readFile(sys.argv[1])
     interp.objects[14] = None
-    import time
     startTime = time.time()
     # interp.prettyPrintObject(interp.activeContext)
     num = 10000000
-    for _ in range(num):
-        interp.interpretOne()
+    interp.run(num)
     for _ in range(1):
         interp.interpretOne(True)
     elapsed = time.time() - startTime
     print("{} second elapsed".format(elapsed))
     print("{} instructions per second".format(num / elapsed))
-    print(interp.highestId)
-    print(len(interp.objects))
+    print(interp.objectTableStats())
+    gcStats = interp.gcStats()
+    print("{} seconds in {} minor and {} full collections".format(gcStats['total pause'], gcStats['minor cycles'], gcStats['full cycles']))
 
     # while True:
     #     interp.interpretOne()
\ No newline at end of file
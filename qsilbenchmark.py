@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# Microbenchmarks for the QSIL object model
+
+import ctypes
+import time
+import tracemalloc
+
+from qsilInterpreter import Object, Pointer, SpecialIDs
+
+# The ctypes based object model QSIL used to have, kept here
+# so there's something to compare the current one against
+class CtypesQSILObject(ctypes.Structure):
+    _pack_ = 1
+    _fields_ = [
+        ('type', ctypes.c_uint8),
+        ('objId', ctypes.c_uint32)
+    ]
+    def __init__(self, *args, **kwargs):
+        super(CtypesQSILObject, self).__init__(*args, **kwargs)
+        self.interp = None
+        self._cachedself = None
+
+class CtypesPointer(CtypesQSILObject):
+    _pack_ = 1
+    _fields_ = [
+    ]
+
+class CtypesObject(CtypesQSILObject):
+    _pack_ = 1
+    _fields_ = [
+        ('classId', ctypes.c_uint32)
+    ]
+    def __init__(self, *args, **kwargs):
+        super(CtypesObject, self).__init__(*args, **kwargs)
+        self.pyObjStorage = []
+
+def bytesPerObject(cls, count):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    objs = [cls() for _ in range(count)]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del objs
+    return (after - before) / count
+
+def attributeAccessTime(cls, count):
+    obj = cls()
+    obj.objId = 42
+    obj.classId = SpecialIDs.INTEGER_CLASS_ID
+    startTime = time.perf_counter()
+    for _ in range(count):
+        obj.objId
+        obj.classId
+        obj.pyObjStorage
+        obj.objId = 42
+    return time.perf_counter() - startTime
+
+def allocationTime(cls, count):
+    startTime = time.perf_counter()
+    for _ in range(count):
+        cls()
+    return time.perf_counter() - startTime
+
+def benchmarkObjectModel(count=200000):
+    results = {}
+    for name, objCls, ptrCls in [('ctypes', CtypesObject, CtypesPointer), ('slots', Object, Pointer)]:
+        results[name] = {
+            'object bytes': bytesPerObject(objCls, count),
+            'pointer bytes': bytesPerObject(ptrCls, count),
+            'attribute access (s)': attributeAccessTime(objCls, count),
+            'allocation (s)': allocationTime(objCls, count),
+        }
+    return results
+
+if __name__ == '__main__':
+    results = benchmarkObjectModel()
+    for measurement in results['ctypes']:
+        old = results['ctypes'][measurement]
+        new = results['slots'][measurement]
+        print("{:<22} ctypes {:>10.3f}  slots {:>10.3f}  ({:.1f}x)".format(measurement, old, new, old / new))
@@ -1,9 +1,18 @@
 #!/usr/bin/env python3
 
-from qsilInterpreter import Object, Pointer, Interpreter, Bytecode, SpecialIDs, VisibilityTypes, QSIL_TYPE_DIRECTOBJECT, QSIL_TYPE_DIRECTPOINTEROBJECT
+from qsilInterpreter import Object, Pointer, SmallInteger, Interpreter, Bytecode, SpecialIDs, VisibilityTypes, QSIL_TYPE_DIRECTOBJECT, QSIL_TYPE_DIRECTPOINTEROBJECT, imageFormat, writeImageV2
+from qsilInterpreter import BYTECODE_OPERAND_SIZES, JUMP_BYTECODES, SUPERINSTRUCTIONS, SPECIAL_SELECTORS, bytecodeInstructions
+import io
+import sys
 from struct import pack
 
 printBytecodes = False
+printObjects = False # Print every object as it's written out
+useSuperinstructions = True # Fuse bytecode pairs, see fuseBytecodes
+inlineControlStructures = True # Compile ifTrue:, whileTrue: and friends to jumps, see inlineSend
+useCleanBlocks = True # Share blocks that don't need a context around them, see isCleanBlock
+
+specialSelectorNames = [selector for selector, _ in SPECIAL_SELECTORS]
 
 classClassInstVars = []
 methodClassInstVars = []
@@ -69,6 +78,91 @@ class QSILClass(object):
         parser.classes[self.name] = ret
 
 
+def fuseBytecodes(bytecodes):
+    # Replace each pair of instructions in SUPERINSTRUCTIONS with the one
+    # that does both, unless something jumps to the second of the pair,
+    # then point the jumps at where their targets ended up. Bytecodes
+    # with a jump that doesn't land on an instruction are left alone
+    instructions = list(bytecodeInstructions(bytecodes))
+    jumps = [operand for _, bc, operand in instructions if bc in JUMP_BYTECODES]
+    if any(len(operand) != 4 for operand in jumps):
+        return bytecodes
+    jumpTargets = {int.from_bytes(operand, 'little') for operand in jumps}
+
+    fused = []
+    i = 0
+    while i < len(instructions):
+        pc, bc, operand = instructions[i]
+        if i + 1 < len(instructions):
+            nextPc, nextBc, _ = instructions[i + 1]
+            superBc = SUPERINSTRUCTIONS.get((bc, nextBc))
+            if (superBc is not None and nextPc not in jumpTargets and
+                    len(operand) == BYTECODE_OPERAND_SIZES.get(superBc, 0)):
+                fused.append((pc, superBc, operand))
+                i += 2
+                continue
+        fused.append((pc, bc, operand))
+        i += 1
+
+    newPcs = {}
+    newPc = 0
+    for pc, bc, operand in fused:
+        newPcs[pc] = newPc
+        newPc += 1 + len(operand)
+    newPcs[len(bytecodes)] = newPc
+    if not jumpTargets.issubset(newPcs):
+        return bytecodes
+
+    output = bytearray()
+    for pc, bc, operand in fused:
+        if bc in JUMP_BYTECODES:
+            operand = pack("<I", newPcs[int.from_bytes(operand, 'little')])
+        output.append(bc)
+        output += operand
+    return bytes(output)
+
+def resolveJumps(bytecodes):
+    # Swap the compiler's ['jump', bytecode, label] and ['label', label]
+    # for real jumps, once every other instruction's size is known
+    labelPcs = {}
+    pc = 0
+    for bc in bytecodes:
+        if isinstance(bc, list):
+            if bc[0] == 'label':
+                labelPcs[bc[1]] = pc
+            else:
+                pc += 1 + BYTECODE_OPERAND_SIZES[bc[1]]
+        elif isinstance(bc, bytes):
+            pc += len(bc)
+        else:
+            pc += 1
+
+    resolved = []
+    for bc in bytecodes:
+        if isinstance(bc, list):
+            if bc[0] == 'jump':
+                resolved.append(bc[1])
+                resolved.append(pack("<I", labelPcs[bc[2]]))
+        else:
+            resolved.append(bc)
+    return resolved
+
+def isCleanBlock(bytecodes, outerArgs, outerTemps):
+    # Whether a block's (finished, unfused) bytecodes get by without self,
+    # the args and temps around it, or a home context to return to with ^.
+    # Those can push the block literal itself, the rest need PUSH_CLOSURE
+    # to get a copy bound to the running context
+    for _, bc, operand in bytecodeInstructions(bytecodes):
+        if bc in (Bytecode.PUSH_SELF, Bytecode.PUSH_SUPER, Bytecode.PUSH_INSTVAR,
+                  Bytecode.POP_INTO_INSTVAR, Bytecode.RETURN, Bytecode.PUSH_THISCONTEXT,
+                  Bytecode.PUSH_CLOSURE):
+            return False
+        if bc == Bytecode.PUSH_ARG and operand[0] < outerArgs:
+            return False
+        if bc in (Bytecode.PUSH_TEMP, Bytecode.POP_INTO_TEMP) and operand[0] < outerTemps:
+            return False
+    return True
+
 class QSILMethod(object):
     def __init__(self):
         self.name = b''
@@ -78,6 +172,7 @@ class QSILMethod(object):
         self.literalPtrs = []
         self.objId = 0
         self.numTemps = 0
+        self.primitive = 0 # No primitive
         self._class = None
 
     def __repr__(self):
@@ -113,9 +208,13 @@ class QSILMethod(object):
                         finalBytecodes += bc
                     else:
                         finalBytecodes += bytes([bc])
+                if useSuperinstructions:
+                    finalBytecodes = fuseBytecodes(finalBytecodes)
                 serializedInstVars.append(parser.qsilStringPtr(finalBytecodes))
             elif var == b'literals':
                 serializedInstVars.append(parser.qsilOrderedCollectionPtr(self.literalPtrs))
+            elif var == b'primitive':
+                serializedInstVars.append(parser.qsilNumberPtr(self.primitive))
             elif var == b'numTemps':
                 print("At some point, this should be implemented. It's kinda important ish")
             elif var == b'class':
@@ -131,9 +230,9 @@ class QSILMethod(object):
         parser.objects[ret.objId] = ret
         return Pointer.forObject(ret)
 
-specials = [b'+', b',' b'-', b'/', b'*', b'>',
+specials = [b'+', b',', b'-', b'/', b'*', b'>',
             b'<', b'<=',b'>=', b'=', b'~=', b'==',
-            b'~==', b'&&', b'||', b'\\']
+            b'~==', b'&&', b'||', b'\\', b'%', b'//']
 
 
 class Parser(object):
@@ -173,6 +272,48 @@ class Parser(object):
         self.stream.seek(pos)
         return ret
 
+    def skipBlock(self):
+        # Move past the block at the stream position without compiling it
+        self.skipwhitespace()
+        assert self.stream.read(1) == b'['
+        depth = 1
+        while depth:
+            char = self.stream.read(1)
+            assert char, "Unterminated block"
+            if char == b'[':
+                depth += 1
+            elif char == b']':
+                depth -= 1
+            elif char == b'$':
+                self.stream.read(1)
+            elif char in (b'\'', b'"'):
+                while self.stream.read(1) not in (char, b''):
+                    pass
+
+    def blockArgCount(self):
+        # How many arguments the literal block at the stream position
+        # takes, or None if there isn't one there
+        pos = self.stream.tell()
+        self.skipwhitespace()
+        count = None
+        if self.stream.read(1) == b'[':
+            count = 0
+            while self.peekToken().startswith(b':'):
+                self.readToken()
+                count += 1
+        self.stream.seek(pos)
+        return count
+
+    def tokenAfterBlock(self):
+        # The token after the block at the stream position, and how many
+        # arguments the block after that takes (None if it isn't one)
+        pos = self.stream.tell()
+        self.skipBlock()
+        tok = self.readToken()
+        argCount = self.blockArgCount()
+        self.stream.seek(pos)
+        return tok, argCount
+
     def readString(self):
         string = b''
         self.skipwhitespace()
@@ -224,6 +365,8 @@ class Parser(object):
         return Pointer.forObject(qsilCharacter)
 
     def qsilNumberPtr(self, num):
+        if SmallInteger.canHold(num):
+            return SmallInteger.forValue(num)
         qsilNumber = Object()
         qsilNumber.classId = SpecialIDs.INTEGER_CLASS_ID if isinstance(num, int) else SpecialIDs.FLOAT_CLASS_ID
         qsilNumber.type = QSIL_TYPE_DIRECTOBJECT
@@ -253,7 +396,9 @@ class Parser(object):
         receiverPtr = Pointer()
         receiverPtr.objId = SpecialIDs.NIL_OBJECT_ID
         tempvarsPtr = self.qsilOrderedCollectionPtr([])
-        argsPtr = self.qsilOrderedCollectionPtr([])
+        # Room for the args around the block, which its own come after
+        # (a copy made for PUSH_CLOSURE has the real ones)
+        argsPtr = self.qsilOrderedCollectionPtr([receiverPtr for _ in methodargs])
         parentContextPtr = Pointer()
         parentContextPtr.objId = SpecialIDs.NIL_OBJECT_ID
         bytecodesPtr = self.qsilStringPtr(bytecodes)
@@ -324,9 +469,9 @@ class Parser(object):
             literals = [None for _ in literalPtrs]
         else:
             literals = []
-        def readObject():
+        def readObject(canInline=False):
             tok = self.peekToken()
-            if tok in [b'true', b'false', b'self', b'super', b'nil']:
+            if tok in [b'true', b'false', b'self', b'super', b'nil', b'thisContext']:
                 if tok == b'true':
                     bytecodes.append(Bytecode.PUSH_TRUE)
                 elif tok == b'false':
@@ -337,6 +482,8 @@ class Parser(object):
                     bytecodes.append(Bytecode.PUSH_SUPER)
                 elif tok == b'nil':
                     bytecodes.append(Bytecode.PUSH_NIL)
+                elif tok == b'thisContext':
+                    bytecodes.append(Bytecode.PUSH_THISCONTEXT)
                 self.readToken()
             elif tok in declaredVariables:
                 # Push tempvar by index onto the stack
@@ -383,6 +530,8 @@ class Parser(object):
                 bytecodeOneLine()
                 self.skipwhitespace()
                 assert self.stream.read(1) == b')'
+            elif tok.startswith(b'[') and canInline and inlineLoop():
+                pass
             elif tok.startswith(b'['):
                 self.skipwhitespace()
                 self.stream.read(1)
@@ -399,8 +548,8 @@ class Parser(object):
                 literals.append(None)
 
                 self.skipwhitespace()
-                bytecodes.append(Bytecode.PUSH_LITERAL) # PUSH_LITERAL
-                bytecodes.append(bytes([len(literals) - 1]))
+                # PUSH_LITERAL or PUSH_CLOSURE, once doLateBinds knows which
+                bytecodes.append(['pushblock', len(literals) - 1, ctxPtr, len(methodargs), len(declaredVariables)])
                 assert self.stream.read(1) == b']'
             else:
                 # Try to read an integer or float, or if that fails, assume it's
@@ -424,6 +573,153 @@ class Parser(object):
                     bytecodes.append(Bytecode.PUSH_LITERAL) # PUSH_LITERAL
                     bytecodes.append(bytes([numPtr]))
 
+        def jumpTo(bc, label):
+            bytecodes.append(['jump', bc, label])
+
+        def placeLabel(label):
+            bytecodes.append(['label', label])
+
+        def openInlinedBlock():
+            # Start compiling a literal block in place instead of making a
+            # BlockContext. Its arguments become temps, and the index of the
+            # first is returned (it's where the block's scope starts)
+            self.skipwhitespace()
+            assert self.stream.read(1) == b'['
+            scopeStart = len(declaredVariables)
+            while self.peekToken().startswith(b':'):
+                declaredVariables.append(self.readToken()[1:])
+                numTemps[0] += 1
+            if len(declaredVariables) > scopeStart:
+                assert self.readToken() == b'|'
+            return scopeStart
+
+        def inlinedBlockBody(scopeStart):
+            # The statements up to the block's ], leaving the value of the
+            # last one (or nil) on the stack
+            hasValue = False
+            while True:
+                while self.peekToken().startswith(b'"'):
+                    self.consumeComment()
+                if self.peekToken() == b']':
+                    break
+                if self.peekToken() == b'|':
+                    bytecodeOneLine()
+                    continue
+                if hasValue:
+                    bytecodes.append(Bytecode.POP)
+                bytecodeOneLine(True, False)
+                if self.peekToken() == b'.':
+                    self.readToken()
+                hasValue = True
+            self.skipwhitespace()
+            assert self.stream.read(1) == b']'
+            if not hasValue:
+                bytecodes.append(Bytecode.PUSH_NIL)
+
+            # The block's arguments and temps go out of scope, but keep their slots
+            for index in range(scopeStart, len(declaredVariables)):
+                declaredVariables[index] = None
+
+        def inlineBlock():
+            inlinedBlockBody(openInlinedBlock())
+
+        def inlineLoop():
+            # [...] whileTrue: [...] and friends, with literal blocks, as a
+            # loop of jumps. Leaves nil, like the real sends
+            if not inlineControlStructures or self.blockArgCount() != 0:
+                return False
+            selName, argCount = self.tokenAfterBlock()
+            if selName in (b'whileTrue', b'whileFalse'):
+                loopStart = object()
+                placeLabel(loopStart)
+                inlineBlock()
+                self.readToken()
+                jumpTo(Bytecode.JUMP_IF_TRUE if selName == b'whileTrue' else Bytecode.JUMP_IF_FALSE, loopStart)
+            elif selName in (b'whileTrue:', b'whileFalse:') and argCount == 0:
+                loopStart, loopEnd = object(), object()
+                placeLabel(loopStart)
+                inlineBlock()
+                self.readToken()
+                jumpTo(Bytecode.JUMP_IF_FALSE if selName == b'whileTrue:' else Bytecode.JUMP_IF_TRUE, loopEnd)
+                inlineBlock()
+                bytecodes.append(Bytecode.POP)
+                jumpTo(Bytecode.JUMP, loopStart)
+                placeLabel(loopEnd)
+            else:
+                return False
+            bytecodes.append(Bytecode.PUSH_NIL)
+            return True
+
+        def inlineSend(selName):
+            # ifTrue:, ifFalse:, both together, and: and or: with literal
+            # blocks as jumps. The receiver is already on the stack and the
+            # keyword has been read. Returns whether it did anything
+            if not inlineControlStructures or self.blockArgCount() != 0:
+                return False
+            otherKeyword = {b'ifTrue:': b'ifFalse:', b'ifFalse:': b'ifTrue:'}.get(selName)
+            nextKeyword, argCount = self.tokenAfterBlock()
+            hasOther = otherKeyword is not None and nextKeyword == otherKeyword
+            if nextKeyword.endswith(b':') and not (hasOther and argCount == 0):
+                return False # Some other message, like ifTrue:ifFalse: with a variable
+
+            elseStart, end = object(), object()
+            jumpTo(Bytecode.JUMP_IF_FALSE if selName in (b'ifTrue:', b'and:') else Bytecode.JUMP_IF_TRUE, elseStart)
+            inlineBlock()
+            jumpTo(Bytecode.JUMP, end)
+            placeLabel(elseStart)
+            if hasOther:
+                self.readToken()
+                inlineBlock()
+            elif selName in (b'ifTrue:', b'and:'):
+                # Like False>>ifTrue: and False>>and:, which answer self
+                bytecodes.append(Bytecode.PUSH_FALSE)
+            else:
+                bytecodes.append(Bytecode.PUSH_TRUE)
+            placeLabel(end)
+            return True
+
+        def inlineToDo():
+            # start to: limit do: [:i | ...], with start and limit already on
+            # the stack and do: next. Counts i up through limit, then leaves
+            # start, like the real send
+            if not inlineControlStructures or self.peekToken() != b'do:':
+                return False
+            pos = self.stream.tell()
+            self.readToken()
+            if self.blockArgCount() != 1:
+                self.stream.seek(pos)
+                return False
+
+            limitName = b'to:do: limit ' + bytes(str(len(declaredVariables)), 'ascii')
+            declaredVariables.append(limitName)
+            numTemps[0] += 1
+            limitIndex = bytes([len(declaredVariables) - 1])
+            scopeStart = openInlinedBlock()
+            counterIndex = bytes([scopeStart])
+
+            bytecodes.extend([Bytecode.POP_INTO_TEMP, limitIndex, Bytecode.POP])
+            bytecodes.extend([Bytecode.POP_INTO_TEMP, counterIndex])
+            loopStart, loopEnd = object(), object()
+            placeLabel(loopStart)
+            bytecodes.extend([Bytecode.PUSH_TEMP, counterIndex, Bytecode.PUSH_TEMP, limitIndex,
+                              Bytecode.SEND_SPECIAL + specialSelectorNames.index(b'<=')])
+            jumpTo(Bytecode.JUMP_IF_FALSE, loopEnd)
+            inlinedBlockBody(scopeStart)
+            bytecodes.append(Bytecode.POP)
+
+            if 1 in literals:
+                onePtr = literals.index(1)
+            else:
+                literalPtrs.append(self.qsilNumberPtr(1))
+                literals.append(1)
+                onePtr = len(literals) - 1
+            bytecodes.extend([Bytecode.PUSH_TEMP, counterIndex, Bytecode.PUSH_LITERAL, bytes([onePtr]),
+                              Bytecode.SEND_SPECIAL + specialSelectorNames.index(b'+'),
+                              Bytecode.POP_INTO_TEMP, counterIndex, Bytecode.POP])
+            jumpTo(Bytecode.JUMP, loopStart)
+            placeLabel(loopEnd)
+            return True
+
         def readSelector(canHaveArgs):
             self.skipwhitespace()
             if self.peek() in [b')', b'.', b']']:
@@ -434,17 +730,26 @@ class Parser(object):
             selName in specials)):
                     return
             self.readToken()
+            if canHaveArgs and selName in (b'ifTrue:', b'ifFalse:', b'and:', b'or:') and inlineSend(selName):
+                return
             while canHaveArgs:
                 if (selName.endswith(b':') or selName in specials):
                     readObject()
                     readSelector(False)
                 if selName in specials or (not selName.endswith(b':')):
                     break
+                if selName == b'to:' and inlineToDo():
+                    return
                 while self.peekToken().endswith(b':'):
                     selName += self.readToken()
-                    bytecodeOneLine(False)
+                    bytecodeOneLine(False, False)
                 break
 
+            if selName in specialSelectorNames:
+                # These have their own bytecodes, which don't need the selector
+                bytecodes.append(Bytecode.SEND_SPECIAL + specialSelectorNames.index(selName))
+                return
+
             # Push a call for ourselves onto the stack
             #print("Got here")
             if selName in literals:
@@ -463,7 +768,7 @@ class Parser(object):
             # Read an initial object
             while self.peekToken().startswith(b'"'):
                 self.consumeComment()
-            if self.peekToken(2)[1] == b':=':
+            if self.peekToken(2)[1] == b':=' and self.peekToken()[0:1].isalpha():
                 # Read the rvalue and then push a bytecode to write by index
                 if self.peekToken() in declaredVariables:
                     varIndex = declaredVariables.index(self.readToken())
@@ -499,7 +804,7 @@ class Parser(object):
                 numTemps[0] += len(newVars)
                 declaredVariables.extend(newVars)
             elif self.peekToken() != b']':
-                readObject()
+                readObject(canHaveArgs)
                 self.consumeComment()
                 while self.peekToken() not in [b')', b']']:
                     self.consumeComment()
@@ -540,7 +845,7 @@ class Parser(object):
             funcName in specials):
             args.append(self.readToken())
         if not funcName in specials:
-            while self.peekToken().endswith(b':'):
+            while self.peekToken().endswith(b':') and not self.peekToken().startswith(b'<'):
                 funcName += self.readToken()
                 args.append(self.readToken())
         newMethod.name = funcName
@@ -549,13 +854,23 @@ class Parser(object):
         # Implement actual method parsing and bytecodes later
         self.skipwhitespace()
         specialBytecodes = []
-        if self.peek() == b'<':
-            # Something special, it's telling us which bytecodes
-            assert self.readToken() == b'<bytecodes'
-            bytecodes = [bytes([int(bc, 16)]) for bc in self.readString().split(b' ')]
-            specialBytecodes = bytecodes
+        while self.peek() == b'<':
+            # Something special, either the method's primitive or
+            # which bytecodes it starts with
+            pragma = self.readToken()
+            if pragma == b'<primitive:':
+                tok = self.readToken()
+                newMethod.primitive = int(tok.rstrip(b'>'))
+                if not tok.endswith(b'>'):
+                    self.skipwhitespace()
+                    assert self.stream.read(1) == b'>'
+            else:
+                assert pragma == b'<bytecodes'
+                bytecodes = [bytes([int(bc, 16)]) for bc in self.readString().split(b' ')]
+                specialBytecodes = bytecodes
+                self.skipwhitespace()
+                assert self.stream.read(1) == b'>'
             self.skipwhitespace()
-            assert self.stream.read(1) == b'>'
         
         bytecodes, literalPtrs = self.methodToBytecodes(args)
 
@@ -677,11 +992,36 @@ class Parser(object):
                             newbytecodes.append(bytes([instVars.index(search)]))
                         else:
                             print(f"Unknown {bc}")
+                    elif bc[0] == 'pushblock':
+                        _, literalIndex, ctxPtr, outerArgs, outerTemps = bc
+                        if fixBlock(self.objects[ctxPtr.objId], outerArgs, outerTemps):
+                            newbytecodes.append(Bytecode.PUSH_LITERAL)
+                        else:
+                            newbytecodes.append(Bytecode.PUSH_CLOSURE)
+                        newbytecodes.append(bytes([literalIndex]))
+                    elif bc[0] in ('jump', 'label'):
+                        newbytecodes.append(bc)
                     else:
                         print(f"UNKNOWN {bc}")
                 else:
                     newbytecodes.append(bc)
-            return newbytecodes
+            return resolveJumps(newbytecodes)
+
+        def fixBlock(blockContext, outerArgs, outerTemps):
+            # Fixes a block's bytecodes along with the method it's in (so
+            # with that class's instance variables), returning if it's clean
+            bytecodeObject = self.objects[blockContext.pyObjStorage[-2].objId]
+            fixedBc = b''
+            for bc in fixBytecodes(bytecodeObject.pyObjStorage):
+                if isinstance(bc, bytes):
+                    fixedBc += bc
+                else:
+                    fixedBc += bytes([bc])
+            isClean = useCleanBlocks and isCleanBlock(fixedBc, outerArgs, outerTemps)
+            if useSuperinstructions:
+                fixedBc = fuseBytecodes(fixedBc)
+            bytecodeObject.pyObjStorage = fixedBc
+            return isClean
         
         # Needs a second pass after getting the names of each
         # instance variable, class variable, and existing classes
@@ -690,18 +1030,11 @@ class Parser(object):
             classVars = classClassVars[eachClass.name]
             for method in eachClass.methods:
                 method.bytecodes = fixBytecodes(method.bytecodes)
-        
-        for bc in self.blockContexts:
-            bytecodeObject = self.objects[bc.pyObjStorage[-2].objId]
-            fixedBc = b''
-            for bc in fixBytecodes(bytecodeObject.pyObjStorage):
-                if isinstance(bc, bytes):
-                    fixedBc += bc
-                else:
-                    fixedBc += bytes([bc])
-            bytecodeObject.pyObjStorage = fixedBc
 
-    def readall(self):
+    def readall(self, outFile=None, version=imageFormat, compress=False):
+        # Compiles the sources and writes the image to outFile, or returns
+        # it as bytes if there's no outFile. compress only applies to
+        # format 2 images
         self.skipwhitespace()
         while self.peek() == b'"':
             self.consumeComment()
@@ -729,7 +1062,7 @@ class Parser(object):
                             print('\t\t{}'.format(bc))
                         print("\n\t\t**LITERALS**")
                         for lit in method.literalPtrs:
-                            print('\t\t{}'.format(self.objects[lit.objId]))
+                            print('\t\t{}'.format(self.objects.get(lit.objId, lit)))
                         #pprint.pprint([funcName, bytecodes, [self.objects[x.objId] for x in literalPtrs]])
                         print(f"\n\t***END FUNCTION #{method.name} ***")
                     print(f"***END CLASS {eachClass.name}***")
@@ -743,7 +1076,7 @@ class Parser(object):
                     print('\t{}'.format(bc))
                 print("\n\t**LITERALS**")
                 for lit in self.objects[context.pyObjStorage[1].objId].pyObjStorage:
-                    print('\t{}'.format(self.objects[lit.objId]))
+                    print('\t{}'.format(self.objects.get(lit.objId, lit)))
                 #pprint.pprint([funcName, bytecodes, [self.objects[x.objId] for x in literalPtrs]])
                 print("\n***END BLOCKCONTEXT***")
 
@@ -796,22 +1129,35 @@ class Parser(object):
         bootstrapCtx.setMem([pcPtr, stackPtr, receiverPtr, tempvarsPtr, parentContextPtr, argsPtr, bootstrapPtr])
         self.objects[bootstrapCtx.objId] = bootstrapCtx
 
-        outputBytes = b''
-        outputBytes += pack("<i", len(self.objects))
-        for obj in sorted(self.objects.values(), key=(lambda x: x.objId)):
-            print(obj)
-            outputBytes += obj.bytesForSerialization()
-
-        outputBytes += pack("<i", bootstrapCtx.objId)
+        if outFile is None:
+            output = io.BytesIO()
+            self.writeImage(output, bootstrapCtx.objId, version, compress)
+            return output.getvalue()
+        self.writeImage(outFile, bootstrapCtx.objId, version, compress)
+
+    def writeImage(self, outFile, contextObjId, version=imageFormat, compress=False):
+        # Streams the objects out in id order
+        objs = [self.objects[objId] for objId in sorted(self.objects)]
+        if printObjects:
+            for obj in objs:
+                print(obj)
+        if version == 2:
+            writeImageV2(outFile, objs, contextObjId, compress)
+        elif version == 1:
+            outFile.write(pack("<i", len(objs)))
+            for obj in objs:
+                obj.writeTo(outFile)
+            outFile.write(pack("<i", contextObjId))
+        else:
+            raise RuntimeError("Unsupported image format {}".format(version))
 
         print("Serialized {} objects".format(len(self.objects)))
 
-        return outputBytes
-
 if __name__ == '__main__':
+    # qsilbootstrapper.py [format], format 2 images are written compressed
     print("QSIL Bootstrapper")
+    version = int(sys.argv[1]) if len(sys.argv) > 1 else imageFormat
     p = Parser(open("qsil1.sources", "rb"))
-    out = p.readall()
-    with open("qsil1.image", "wb") as outFile:
-        outFile.write(out)
-    print("Wrote {} bytes".format(len(out)))
\ No newline at end of file
+    with open(f"qsil{version}.image", "wb") as outFile:
+        p.readall(outFile, version, compress=(version == 2))
+        print("Wrote {} bytes".format(outFile.tell()))
\ No newline at end of file
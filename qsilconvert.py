@@ -0,0 +1,23 @@
+#!/usr/bin/env python3
+# Converts QSIL images between image formats
+
+import sys
+
+from qsilInterpreter import Interpreter, imageFormat
+
+def convertImage(inFileName, outFileName, version=imageFormat, compress=False):
+    # Reads an image in any format (including any snapshot segments
+    # appended to it) and writes it out again as one whole image
+    interp = Interpreter()
+    interp.readFile(inFileName)
+    interp.snapshot(outFileName, version=version, compress=compress)
+    return interp.loadStats, interp.snapshotStats
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print("Usage: qsilconvert.py inputImage outputImage [format] [--compress]")
+        sys.exit(1)
+    version = int(sys.argv[3]) if len(sys.argv) > 3 and sys.argv[3] != '--compress' else imageFormat
+    loadStats, snapshotStats = convertImage(sys.argv[1], sys.argv[2], version, '--compress' in sys.argv)
+    print("Format {} ({} bytes) -> format {} ({} bytes), {} objects".format(
+        loadStats['format'], loadStats['bytes'], version, snapshotStats['bytes'], snapshotStats['objects']))
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# Counts the opcode sequences in an image, to help pick superinstructions.
+# By default it counts what the methods and blocks in the image contain,
+# with --run it counts what the interpreter runs instead
+
+import sys
+from collections import Counter
+
+from qsilInterpreter import Interpreter, Bytecode, SpecialIDs, SPECIAL_SELECTORS, bytecodeInstructions, imageFormat
+
+bytecodeNames = {value: name for name, value in vars(Bytecode).items() if isinstance(value, int)}
+bytecodeNames[-1] = 'END_OF_BLOCK'
+bytecodeNames[0xff] = 'PRINT'
+for index, (selector, _) in enumerate(SPECIAL_SELECTORS):
+    bytecodeNames[Bytecode.SEND_SPECIAL + index] = 'SEND_SPECIAL ' + selector.decode()
+
+def bytecodeName(bc):
+    return bytecodeNames.get(bc, hex(bc))
+
+def imageCode(interp):
+    # The bytecodes of every method and block in the image
+    for obj in interp.objects.values():
+        if obj.classId == SpecialIDs.METHOD_CLASS_ID:
+            yield obj.pyObjStorage[3].pyObjStorage
+        elif obj.classId == SpecialIDs.BLOCKCONTEXT_CLASS_ID:
+            yield obj.pyObjStorage[7].pyObjStorage
+
+def countNgrams(sequences, n):
+    counts = Counter()
+    for sequence in sequences:
+        for i in range(len(sequence) - n + 1):
+            counts[tuple(sequence[i:i + n])] += 1
+    return counts
+
+def staticSequences(interp):
+    return [[bc for _, bc, _ in bytecodeInstructions(bytecodes)] for bytecodes in imageCode(interp)]
+
+def dynamicSequences(interp, numInstructions):
+    # One sequence of everything dispatched, across sends and returns
+    sequence = []
+    for _ in range(numInstructions):
+        sequence.append(interp.code[interp.pc][0])
+        interp.interpretOne()
+    return [sequence]
+
+def mineNgrams(fileName, maxN=3, numInstructions=None):
+    interp = Interpreter()
+    interp.readFile(fileName)
+    interp.objects[14] = None # See qsilInterpreter's __main__
+    if numInstructions is None:
+        sequences = staticSequences(interp)
+    else:
+        sequences = dynamicSequences(interp, numInstructions)
+    total = sum(len(sequence) for sequence in sequences)
+    return total, {n: countNgrams(sequences, n) for n in range(2, maxN + 1)}
+
+if __name__ == '__main__':
+    # qsilngrams.py [image] [--run instructions] [--top count] [--n longest]
+    args = sys.argv[1:]
+    options = {'--run': None, '--top': 15, '--n': 3}
+    for option in options:
+        if option in args:
+            index = args.index(option)
+            options[option] = int(args[index + 1])
+            del args[index:index + 2]
+    fileName = args[0] if args else f'qsil{imageFormat}.image'
+    total, ngrams = mineNgrams(fileName, options['--n'], options['--run'])
+    print("{} opcodes {}".format(total, 'run' if options['--run'] else 'in the image'))
+    for n, counts in ngrams.items():
+        print("\n{}-grams".format(n))
+        for ngram, count in counts.most_common(options['--top']):
+            print("{:>8} {:>6.2f}%  {}".format(count, 100 * count / total, ' '.join(bytecodeName(bc) for bc in ngram)))
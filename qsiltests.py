@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+# Regression checks for the compiler and interpreter. Each check is a QSIL
+# expression and what it should answer. They're compiled into a copy of
+# qsil1.sources, with the compiler's inlining of control structures on and
+# off, and each image is run through both run() and interpretOne()
+
+import contextlib
+import io
+import os
+import sys
+import tempfile
+
+import qsilbootstrapper
+from qsilInterpreter import Interpreter, Object, SmallInteger, SpecialIDs
+
+# Classes added to the sources for the checks to use
+TEST_CLASSES = b'''
+[
+    Object
+        variablePointerSubclass: #QSILTestStack
+        instanceVariableNames: 'top extra'
+        classVariableNames: ''
+        methods: #(
+    [public top
+        ^ top
+    ]
+    [public top: newTop
+        top := newTop
+    ]
+        )
+]
+[
+    Object
+        subclass: #QSILTest
+        instanceVariableNames: ''
+        classVariableNames: ''
+        methods: #(
+    [public static stack
+        | stack |
+        stack := QSILTestStack new: (3).
+        stack top: #top.
+        stack at: 1 put: #first.
+        stack at: 3 put: #last.
+        ^ stack
+    ]
+    [public static changeSelector
+        ^ (#countTo: at: 1 put: 65) isNil and: [(QSILTest countTo: 3) = 3]
+    ]
+    [public static sumTo: n
+        | sum |
+        sum := (0).
+        1 to: n do: [:i | sum := sum + i].
+        ^ sum
+    ]
+    [public static sumWithBlockTo: n
+        | sum block |
+        sum := (0).
+        block := [:i | sum := sum + i].
+        1 to: n do: block.
+        ^ sum
+    ]
+    [public static find: n
+        1 to: 10 do: [:i |
+            (i = n) ifTrue: [^ i * 100]
+        ].
+        ^ 0
+    ]
+    [public static countTo: n
+        | i |
+        i := (0).
+        [i < n] whileTrue: [i := i + 1].
+        ^ i
+    ]
+    [public static cleanBlockTemp
+        ^ [| t | (t == nil) ifTrue: [t := 5] ifFalse: [t := 7]. t] value
+    ]
+        )
+]
+'''
+
+# (expression, expected answer). Answers are compared as Python values,
+# see pythonValue
+CHECKS = [
+    # Integer = and ~= with something that isn't a number
+    (b'3 = nil', False),
+    (b'3 ~= #a', True),
+    (b'(3 ~= #a) ifTrue: [#ran] ifFalse: [#skipped]', b'ran'),
+    (b'3 = 3', True),
+    (b'3 ~= 3', False),
+    # at:, at:put: and size skip named instance variables
+    (b'QSILTest stack size', 3),
+    (b'(QSILTest stack) at: 1', b'first'),
+    (b'(QSILTest stack) at: 3', b'last'),
+    (b'(QSILTest stack) at: 4', None),
+    (b'QSILTest stack top', b'top'),
+    # Symbols can't be changed, they're selectors
+    (b'QSILTest changeSelector', True),
+    # Control structures, inlined or sent
+    (b'(3 > 5) ifTrue: [1] ifFalse: [2]', 2),
+    (b'(3 < 5) ifFalse: [10]', True),
+    (b'(3 > 5) ifTrue: [10]', False),
+    (b'(3 < 5) and: [4 < 2]', False),
+    (b'(3 > 5) or: [4 > 2]', True),
+    (b'QSILTest countTo: 5', 5),
+    (b'QSILTest sumTo: 10', 55),
+    (b'QSILTest sumWithBlockTo: 4', 10),
+    (b'QSILTest find: 4', 400),
+    (b'QSILTest find: 12', 0),
+    # A clean block's temps start out nil every time it runs
+    (b'QSILTest cleanBlockTemp', 5),
+    (b'QSILTest cleanBlockTemp', 5),
+]
+
+def testSources(sourcesFile='qsil1.sources'):
+    # The sources with the test classes, and a Bootstrap that shows the
+    # answer to each check and then loops forever
+    with open(sourcesFile, 'rb') as inFile:
+        sources = inFile.read()
+    sources = sources[:sources.index(b'"Bootstrapper"')]
+    statements = b''.join(b'        console show: (' + expression + b').\n' for expression, _ in CHECKS)
+    return sources + TEST_CLASSES + b'''
+[
+    Object
+        subclass: #Bootstrap
+        instanceVariableNames: ''
+        classVariableNames: ''
+        methods: #(
+    [public static bootstrap
+        | console |
+        console := Transcript new.
+''' + statements + b'''        [true] whileTrue: [nil]
+    ]
+        )
+]'''
+
+def buildImage(sources, inline):
+    # The bootstrapper prints as it goes, which the checks don't need
+    qsilbootstrapper.inlineControlStructures = inline
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            return qsilbootstrapper.Parser(io.BytesIO(sources)).readall()
+    finally:
+        qsilbootstrapper.inlineControlStructures = True
+
+def pythonValue(interp, anObj):
+    if anObj.__class__ is SmallInteger:
+        return anObj.value
+    if anObj is interp.trueObject:
+        return True
+    if anObj is interp.falseObject:
+        return False
+    if anObj is interp.nilObject:
+        return None
+    className = interp.objects[anObj.classId].pyObjStorage[1].pyObjStorage
+    if className in (b'Symbol', b'ByteString'):
+        return bytes(anObj.pyObjStorage)
+    return className.decode()
+
+def runChecks(image, stepping, maxInstructions=200000):
+    # The answers the image's Bootstrap shows, run with run() or, with
+    # stepping, one interpretOne() at a time, and the interpreter
+    with tempfile.NamedTemporaryFile(suffix='.image', delete=False) as imageFile:
+        imageFile.write(image)
+    try:
+        interp = Interpreter()
+        interp.readFile(imageFile.name)
+        interp.objects[14] = None # See qsilInterpreter's __main__
+        answers = []
+        interp.prettyPrintObject = lambda anObj: answers.append(pythonValue(interp, anObj))
+        count = 0
+        while len(answers) < len(CHECKS) and count < maxInstructions:
+            if stepping:
+                interp.interpretOne()
+                count += 1
+            else:
+                count += interp.run(1000)
+        return answers, interp
+    finally:
+        os.unlink(imageFile.name)
+
+def methodCacheChecks(interp):
+    # Putting a method into a class's methods with at:put: has to flush
+    # the send caches. Returns what went wrong
+    testClass = next(obj for obj in interp.objects.values() if obj is not None and
+                     obj.classId == SpecialIDs.CLASS_CLASS_ID and obj.pyObjStorage[1].pyObjStorage == b'QSILTest')
+    methods = testClass.pyObjStorage[5]
+    if not interp.methodCache and not interp.inlineCaches:
+        return ['the send caches were empty before the method changed']
+    method = methods.pyObjStorage[0]
+    if interp.primAtPut(methods, [SmallInteger.forValue(1), method]) is not method:
+        return ['at:put: into a methods collection failed']
+    if interp.methodCache or interp.inlineCaches:
+        return ['at:put: into a methods collection left the send caches full']
+    return []
+
+def scavengeChecks(interp):
+    # A class made since the last scavenge that's only reachable through
+    # its instance's class id has to survive. Returns what went wrong
+    testClass = next(obj for obj in interp.objects.values() if obj is not None and
+                     obj.classId == SpecialIDs.CLASS_CLASS_ID and obj.pyObjStorage[1].pyObjStorage == b'QSILTest')
+    newClass = Object()
+    newClass.interp = interp
+    newClass.classId = SpecialIDs.CLASS_CLASS_ID
+    newClass.setMem(list(testClass.pyObjStorage))
+    interp.addObject(newClass)
+    interp.pushToStack(interp.instantiate(newClass))
+    interp.scavenge()
+    interp.popFromStack()
+    if interp.objects[newClass.objId] is not newClass:
+        return ['a scavenge freed a class that was only reachable through its instance']
+    return []
+
+def main():
+    sources = testSources()
+    failures = 0
+    for inline in (True, False):
+        image = buildImage(sources, inline)
+        for stepping in (False, True):
+            mode = '{}, {}'.format('inlined' if inline else 'sent', 'interpretOne' if stepping else 'run')
+            answers, interp = runChecks(image, stepping)
+            for problem in methodCacheChecks(interp) + scavengeChecks(interp):
+                failures += 1
+                print('FAIL ({}): {}'.format(mode, problem))
+            for index, (expression, expected) in enumerate(CHECKS):
+                answer = answers[index] if index < len(answers) else 'no answer'
+                if answer != expected:
+                    failures += 1
+                    print('FAIL ({}): {} answered {!r}, expected {!r}'.format(
+                        mode, expression.decode(), answer, expected))
+    print('{} checks, {} failures'.format(4 * (len(CHECKS) + 2), failures))
+    return failures
+
+if __name__ == '__main__':
+    sys.exit(1 if main() else 0)